@@ -1,12 +1,26 @@
 # -*- coding: utf8 -*-
 import os
 import sys
+import signal
 import socket
 import errno
 import time
+import math
+import random
+import mmap
 import struct
 import logging
 import asyncore
+import codecs
+import collections
+import threading
+import traceback
+import zlib
+
+try:
+    import selectors
+except ImportError:
+    selectors = None
 
 PY2 = sys.version_info[0] == 2
 PY3 = sys.version_info[0] == 3
@@ -22,18 +36,24 @@ try:
 except ImportError:
     import pickle
 
-__version__ = '0.2.4'
+__version__ = '0.3.0'
 __all__ = [
     "Error",
     "SessionS", "SessionC",
-    "Server", "Client", "ClientInfinite",
-    "run_once", "run_forever",
+    "Server", "PreforkServer", "Client", "ClientInfinite", "ClientPool",
+    "run_once", "run_forever", "start_clients",
+    "RetryPolicy", "set_max_connecting", "get_max_connecting",
     "Sleep",
+    "Timer", "call_later", "call_at",
     "logger",
-    "AsynMsgException", "MessageSizeOverflowError",
-    "with_message_handler_config", "message_handler_config",
-    "SessionKeepAliveParams",
-    "MessagePacker", "MessagePacker_Pickle", "MessagePacker_Struct",
+    "AsynMsgException", "MessageSizeOverflowError", "RpcError", "RpcTimeoutError", "RpcCall",
+    "with_message_handler_config", "message_handler_config", "set_executor",
+    "SessionKeepAliveParams", "SessionCompressionParams", "SessionStreamParams", "SessionFlowControlParams",
+    "SessionRpcParams",
+    "Metrics",
+    "Watchdog", "set_watchdog", "get_watchdog",
+    "Profiler", "set_profiler", "get_profiler",
+    "MessagePacker", "MessagePacker_Pickle", "MessagePacker_Pickle5", "MessagePacker_Struct", "MessagePacker_Schema",
 ]
 
 
@@ -41,23 +61,10 @@ def _str_system_error(code):
     return '%d:%s' % (code, errno.errorcode.get(code, 'unknown'))
 
 
-def _connect_with_timeout(sock, address, timeout):
-    sock.setblocking(False)
-    end_time = time.time() + timeout
-
-    while True:
-        time.sleep(0.001)
-        code = sock.connect_ex(address)
-        if code in (errno.EINPROGRESS, errno.EALREADY, errno.EWOULDBLOCK) \
-                or (code == errno.WSAEINVAL and os.name in ('nt', 'ce')):
-            if end_time < time.time():
-                return 1, None  # timeout
-            else:
-                continue
-        if code in (0, errno.EISCONN):
-            return 0, None  # connected
-        else:
-            return -1, code  # error
+def _get_function(cls, name):
+    """The plain function of a method, comparable between PY2 and PY3"""
+    func = getattr(cls, name)
+    return getattr(func, '__func__', func)
 
 
 def _is_valid_message_format(msg):
@@ -83,6 +90,19 @@ def _wrapper_asyncore_log(msg, type):
 
 logger = logging.getLogger("asynmsg")
 
+_perf_counter = getattr(time, 'perf_counter', time.time)
+
+
+def _cpu_count():
+    try:
+        return os.cpu_count() or 1
+    except AttributeError:  # PY2
+        import multiprocessing
+        return multiprocessing.cpu_count()
+
+
+_SESSION_COUNT_STRUCT = struct.Struct('I')
+
 
 class Sleep:
     def __init__(self, seconds):
@@ -92,18 +112,396 @@ class Sleep:
         time.sleep(self.seconds)
 
 
+class Timer:
+    """Handle returned by call_later/call_at"""
+    def __init__(self, wheel, when, callback, args):
+        self.when = when
+        self._wheel = wheel
+        self._expires = wheel.to_tick(when)
+        self._callback = callback
+        self._args = args
+        self._slot = None
+        self._level = 0
+        self._cancelled = False
+
+    def cancel(self):
+        if self._cancelled:
+            return
+        self._cancelled = True
+        if self._slot is not None:
+            self._wheel.remove(self)
+
+    def is_cancelled(self):
+        return self._cancelled
+
+    def _run(self):
+        try:
+            self._callback(*self._args)
+        except Exception:
+            logger.exception('timer callback %r error', self._callback)
+
+
+class _TimerWheel:
+    """
+    Hierarchical timing wheel(like the linux kernel one): the root level has 256 slots of one tick,
+    each upper level has 64 slots covering 64 times longer than the level below.
+    add/cancel are O(1), advancing only visits the due slot and cascades an upper slot every 256 ticks.
+    """
+    ROOT_SIZE = 256
+    LEVEL_SIZE = 64
+    LEVEL_COUNT = 5
+
+    def __init__(self, resolution=0.001):
+        self._resolution = resolution
+        self._current = int(time.time() / resolution)
+        self._levels = [[{} for _ in range(self.ROOT_SIZE)]] + \
+                       [[{} for _ in range(self.LEVEL_SIZE)] for _ in range(self.LEVEL_COUNT - 1)]
+        self._level_counts = [0] * self.LEVEL_COUNT
+        self._count = 0
+
+    def to_tick(self, when):
+        return int(math.ceil(when / self._resolution))
+
+    def add(self, when, callback, args):
+        timer = Timer(self, when, callback, args)
+        self._insert(timer)
+        return timer
+
+    def remove(self, timer):
+        del timer._slot[timer]
+        timer._slot = None
+        self._level_counts[timer._level] -= 1
+        self._count -= 1
+
+    def next_expiry(self):
+        """Lower bound of the earliest expire time, None if no timer"""
+        if self._count == 0:
+            return None
+
+        best = None
+        if self._level_counts[0] > 0:
+            root = self._levels[0]
+            for i in range(1, self.ROOT_SIZE + 1):
+                if root[(self._current + i) & (self.ROOT_SIZE - 1)]:
+                    best = self._current + i
+                    break
+
+        shift = 8
+        for level in range(1, self.LEVEL_COUNT):
+            if self._level_counts[level] > 0:
+                slots = self._levels[level]
+                base = self._current >> shift
+                for i in range(1, self.LEVEL_SIZE + 1):
+                    if slots[(base + i) & (self.LEVEL_SIZE - 1)]:
+                        cascade_tick = (base + i) << shift
+                        if best is None or cascade_tick < best:
+                            best = cascade_tick
+                        break
+            shift += 6
+
+        return best * self._resolution
+
+    def advance(self, now):
+        target = int(now / self._resolution)
+        while self._current < target:
+            if self._count == 0:
+                self._current = target
+                break
+
+            if self._level_counts[0] == 0:  # nothing can expire before the next cascade
+                last_tick = self._current | (self.ROOT_SIZE - 1)
+                if last_tick >= target:
+                    self._current = target
+                    break
+                self._current = last_tick
+
+            self._current += 1
+            index = self._current & (self.ROOT_SIZE - 1)
+            if index == 0:
+                self._cascade()
+
+            slot = self._levels[0][index]
+            if slot:
+                self._levels[0][index] = {}
+                self._level_counts[0] -= len(slot)
+                self._count -= len(slot)
+                for timer in slot:
+                    timer._slot = None
+                for timer in slot:
+                    if not timer._cancelled:
+                        timer._cancelled = True  # fired, cancel becomes a no-op
+                        timer._run()
+
+    def _cascade(self):
+        shift = 8
+        for level in range(1, self.LEVEL_COUNT):
+            index = (self._current >> shift) & (self.LEVEL_SIZE - 1)
+            slot = self._levels[level][index]
+            if slot:
+                self._levels[level][index] = {}
+                self._level_counts[level] -= len(slot)
+                self._count -= len(slot)
+                for timer in slot:
+                    self._insert(timer)
+            if index != 0:
+                break
+            shift += 6
+
+    def _insert(self, timer):
+        expires = max(timer._expires, self._current + 1)
+        delta = expires - self._current
+        if delta < self.ROOT_SIZE:
+            level = 0
+            index = expires & (self.ROOT_SIZE - 1)
+        else:
+            level = 1
+            shift = 8
+            while level < self.LEVEL_COUNT - 1 and delta >= (1 << (shift + 6)):
+                level += 1
+                shift += 6
+            if delta >= (1 << (shift + 6)):  # too far, park in the farthest slot and cascade again later
+                expires = self._current + (1 << (shift + 6)) - 1
+            index = (expires >> shift) & (self.LEVEL_SIZE - 1)
+
+        slot = self._levels[level][index]
+        slot[timer] = None
+        timer._slot = slot
+        timer._level = level
+        self._level_counts[level] += 1
+        self._count += 1
+
+
+_timer_wheel = _TimerWheel()
+
+
+def call_at(when, callback, *args):
+    """Call callback(*args) in the loop at time 'when'(in time.time() unit), return a Timer"""
+    return _timer_wheel.add(when, callback, args)
+
+
+def call_later(delay, callback, *args):
+    """Call callback(*args) in the loop after 'delay' seconds, return a Timer"""
+    return _timer_wheel.add(time.time() + delay, callback, args)
+
+
+class _Reactor:
+    """
+    Selector(epoll/kqueue/...) based replacement of asyncore.loop.
+
+    Dispatchers are registered when their socket is attached and their interest mask is only
+    recomputed when they ask for it (see AsynMsgDispatcher.update_interest) or after they got an
+    I/O event, so one poll costs O(ready + changed) instead of O(all dispatchers).
+    Plain asyncore dispatchers of asyncore.socket_map have no such hooks, they are found in the map
+    and their mask is recomputed every poll, like asyncore.loop does.
+    """
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self._masks = {}  # fd -> registered mask
+        self._dirty = {}  # fd -> dispatcher whose mask need recompute
+        self._owned = {}  # fd -> AsynMsgDispatcher added
+        self._foreign = {}  # fd -> plain asyncore dispatcher of asyncore.socket_map
+        self.last_wait_time = 0  # seconds blocked in the last select
+
+        # wakeup() makes a blocking poll return, e.g. from a signal handler or another thread
+        self._waker_r, self._waker_w = socket.socketpair()
+        self._waker_r.setblocking(False)
+        self._waker_w.setblocking(False)
+        self._selector.register(self._waker_r.fileno(), selectors.EVENT_READ, None)
+
+    def close(self):
+        self._selector.close()
+        self._waker_r.close()
+        self._waker_w.close()
+
+    def wakeup(self):
+        try:
+            self._waker_w.send(b'\0')
+        except socket.error:
+            pass  # buffer full, a wakeup is already pending
+
+    def add(self, dispatcher):
+        self._owned[dispatcher._fileno] = dispatcher
+        self._dirty[dispatcher._fileno] = dispatcher
+
+    def update(self, dispatcher):
+        fd = dispatcher._fileno
+        if fd is not None:
+            self._dirty[fd] = dispatcher
+
+    def remove(self, dispatcher):
+        fd = dispatcher._fileno
+        if fd is None:
+            return
+        self._owned.pop(fd, None)
+        self._unregister(fd)
+
+    def _unregister(self, fd):
+        self._dirty.pop(fd, None)
+        if self._masks.pop(fd, 0):
+            self._selector.unregister(fd)
+
+    def poll(self, timeout):
+        self._update_foreign()
+        self._flush()
+
+        start_time = _perf_counter()
+        try:
+            events = self._selector.select(timeout)
+        except InterruptedError:
+            return
+        finally:
+            self.last_wait_time = _perf_counter() - start_time
+
+        for key, mask in events:
+            dispatcher = key.data
+            if dispatcher is None:
+                self._drain_waker()
+                continue
+            if mask & selectors.EVENT_READ:
+                asyncore.read(dispatcher)
+            if mask & selectors.EVENT_WRITE and dispatcher._fileno == key.fd:
+                asyncore.write(dispatcher)
+            if dispatcher._fileno == key.fd:
+                self._dirty[key.fd] = dispatcher
+
+    def _update_foreign(self):
+        socket_map = asyncore.socket_map
+        if not self._foreign and len(socket_map) <= len(self._owned):
+            return  # only AsynMsgDispatchers, the usual case costs nothing
+
+        for fd, dispatcher in list(self._foreign.items()):
+            if socket_map.get(fd) is not dispatcher:  # closed
+                del self._foreign[fd]
+                self._unregister(fd)
+        if len(socket_map) > len(self._owned) + len(self._foreign):
+            for fd, dispatcher in socket_map.items():
+                if fd not in self._owned and fd not in self._foreign:
+                    self._foreign[fd] = dispatcher
+        self._dirty.update(self._foreign)
+
+    def _drain_waker(self):
+        try:
+            while self._waker_r.recv(4096):
+                pass
+        except socket.error:
+            pass
+
+    def _flush(self):
+        if not self._dirty:
+            return
+
+        dirty = self._dirty
+        self._dirty = {}
+        for fd, dispatcher in dirty.items():
+            mask = 0
+            if dispatcher.readable():
+                mask |= selectors.EVENT_READ
+            if dispatcher.writable() and not dispatcher.accepting:
+                mask |= selectors.EVENT_WRITE
+
+            old_mask = self._masks.get(fd, 0)
+            if mask == old_mask:
+                continue
+            if old_mask == 0:
+                self._selector.register(fd, mask, dispatcher)
+            elif mask == 0:
+                self._selector.unregister(fd)
+            else:
+                self._selector.modify(fd, mask, dispatcher)
+            if mask == 0:
+                del self._masks[fd]
+            else:
+                self._masks[fd] = mask
+
+
+if selectors is not None:
+    _reactor = _Reactor()
+else:
+    _reactor = None  # fallback to asyncore.loop
+
+
 _runner_list = []
+_pending_calls = collections.deque()  # (func, args) queued by other threads
+
 
+def _call_soon_threadsafe(func, *args):
+    """Run func(*args) in the loop thread, can be called from any thread"""
+    _pending_calls.append((func, args))
+    if _reactor is not None:
+        _reactor.wakeup()
 
-def _run_once(runner_list, extra_tick, use_poll):
+
+def _run_pending_calls():
+    for _ in range(len(_pending_calls)):
+        func, args = _pending_calls.popleft()
+        try:
+            func(*args)
+        except Exception:
+            logger.exception('call %r error', func)
+
+
+def _reinit_after_fork():
+    """Forget the reactor, timers and runners inherited by a forked child process"""
+    global _reactor, _timer_wheel
+    if _reactor is not None:
+        _reactor.close()
+        _reactor = _Reactor()
+    _timer_wheel = _TimerWheel()
+    del _runner_list[:]
+    _pending_calls.clear()
+    _executors.clear()  # pool threads do not survive fork
+    _connect_limiter.connecting = 0
+    _connect_limiter._waiting.clear()
+    asyncore.socket_map.clear()
+
+
+def _poll(use_poll, timeout):
+    if _reactor is None:
+        asyncore.loop(30.0 if timeout is None else timeout, use_poll, None, 1)
+    else:
+        _reactor.poll(timeout)
+
+
+def _get_poll_timeout(runner_list, timeout):
+    """Wait at most 'timeout' seconds(None means no limit), but never beyond the earliest runner deadline"""
+    if timeout == 0:
+        return 0
+
+    deadline = _timer_wheel.next_expiry()
+    for runner in runner_list:
+        if not hasattr(runner, 'get_next_deadline'):
+            return 0
+        runner_deadline = runner.get_next_deadline()
+        if runner_deadline is not None and (deadline is None or runner_deadline < deadline):
+            deadline = runner_deadline
+
+    if deadline is None:
+        return timeout
+
+    wait = max(0, deadline - time.time())
+    if timeout is not None:
+        wait = min(wait, timeout)
+    return wait
+
+
+def _run_once(runner_list, extra_tick, use_poll, timeout):
     """
     :return True - success; False - extra_tick failure; runner object - the runner who tick failure
     """
+    watchdog = _watchdog
+    if watchdog is not None:
+        start_time = _perf_counter()
+    if len(runner_list) > 0:
+        _poll(use_poll, _get_poll_timeout(runner_list, timeout))
+    _run_pending_calls()
+    _timer_wheel.advance(time.time())
     if len(runner_list) > 0:
-        asyncore.loop(0, use_poll, None, 1)
         for runner in runner_list:
             if not runner.tick():
                 return runner
+    if watchdog is not None:
+        waited = _reactor.last_wait_time if _reactor is not None else 0
+        watchdog.on_iteration(_perf_counter() - start_time - waited)
     if extra_tick is not None:
         code = extra_tick()
         if code is False:
@@ -111,8 +509,12 @@ def _run_once(runner_list, extra_tick, use_poll):
     return True
 
 
-def run_once(runner_list=None, extra_tick=Sleep(0.001), use_poll=False, auto_stop=True):
+def run_once(runner_list=None, extra_tick=Sleep(0.001), use_poll=False, auto_stop=True, timeout=0):
     """
+    :param use_poll only used when the selectors module is unavailable and asyncore.loop is the fallback
+    :param timeout max seconds to block waiting for I/O, None means no limit,
+        the wait always ends at the earliest deadline(keep alive, force close, reconnect...) of the runners,
+        so run_forever(extra_tick=None, timeout=None) is a pure event driven loop
     :param auto_stop when tick error occur, stop all runners, except:
         if error was from a runner tick and the runner has set 'only_stop_self_when_tick_error' to True,
         then only this runner stop
@@ -120,7 +522,7 @@ def run_once(runner_list=None, extra_tick=Sleep(0.001), use_poll=False, auto_sto
     if runner_list is None:
         runner_list = _runner_list
 
-    code = _run_once(runner_list, extra_tick, use_poll)
+    code = _run_once(runner_list, extra_tick, use_poll, timeout)
     if code is True:  # no error
         return True
     elif code is False:  # extra tick error
@@ -141,12 +543,12 @@ def run_once(runner_list=None, extra_tick=Sleep(0.001), use_poll=False, auto_sto
     return True
 
 
-def run_forever(runner_list=None, extra_tick=Sleep(0.001), use_poll=False, auto_stop=True):
+def run_forever(runner_list=None, extra_tick=Sleep(0.001), use_poll=False, auto_stop=True, timeout=0):
     if runner_list is None:
         runner_list = _runner_list
 
     while True:
-        if not run_once(runner_list, extra_tick, use_poll, auto_stop):
+        if not run_once(runner_list, extra_tick, use_poll, auto_stop, timeout):
             break
 
 
@@ -164,6 +566,8 @@ class Error:
     ERROR_CONNECT_TIMEOUT = -10
     ERROR_CONNECT_OPEN = -11
     ERROR_CONNECT_REFUSED = -12
+    ERROR_RECV_STREAM_OVERFLOW = -13
+    ERROR_SEND_BUFFER_OVERFLOW = -14
 
     BASE_STR_ERROR_MAP = {
         ERROR_OK: 'ERROR_OK',
@@ -179,6 +583,8 @@ class Error:
         ERROR_CONNECT_TIMEOUT: 'ERROR_CONNECT_TIMEOUT',
         ERROR_CONNECT_OPEN: 'ERROR_CONNECT_OPEN',
         ERROR_CONNECT_REFUSED: 'ERROR_CONNECT_REFUSED',
+        ERROR_RECV_STREAM_OVERFLOW: 'ERROR_RECV_STREAM_OVERFLOW',
+        ERROR_SEND_BUFFER_OVERFLOW: 'ERROR_SEND_BUFFER_OVERFLOW',
     }
 
     @staticmethod
@@ -223,6 +629,19 @@ class Error:
         return self._system_error != 0
 
 
+class _SessionError(Error):
+    """Error of a session, setting it marks the session dirty so that its Server ticks it"""
+    def __init__(self, session):
+        Error.__init__(self)
+        self._session = session
+
+    def set_error(self, error, system_error=0):
+        if self.has_error():
+            return
+        Error.set_error(self, error, system_error)
+        self._session._mark_dirty()
+
+
 class AsynMsgException(Exception):
     pass
 
@@ -237,6 +656,76 @@ class MessageSizeOverflowError(AsynMsgException):
         return 'MessageSizeOverflowError: msg_id=%s size=%d max_size=%d' % (self.msg_id, self.size, self.max_size)
 
 
+class RpcError(AsynMsgException):
+    """A call failed: error replied by the peer, or the session closed"""
+    pass
+
+
+class RpcTimeoutError(RpcError):
+    pass
+
+
+class RpcCall:
+    """Handle of a pending Session.call, completed in the loop thread"""
+    def __init__(self, call_id, msg_id):
+        self.call_id = call_id
+        self.msg_id = msg_id
+        self._done = False
+        self._result = None
+        self._error = None
+        self._callbacks = []
+        self._session = None
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        """The reply data, raise RpcError if failed or not done yet"""
+        if not self._done:
+            raise RpcError('call(%s) of message(%s) is not done' % (self.call_id, self.msg_id))
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def exception(self):
+        return self._error
+
+    def add_done_callback(self, callback):
+        """callback(call) is called in the loop thread once done"""
+        if self._done:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def cancel(self):
+        """Forget the call, the reply will be ignored and callbacks never called"""
+        if self._done:
+            return False
+        self._done = True
+        self._callbacks = []
+        if self._session is not None:
+            self._session._forget_call(self.call_id)
+        return True
+
+    def _complete(self, result, error):
+        self._done = True
+        self._result = result
+        self._error = error
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                logger.exception('call(%s) of message(%s) callback error', self.call_id, self.msg_id)
+
+
+def _smooth_rtt(srtt, rtt):
+    """RFC 6298 smoothed round trip time"""
+    if srtt is None:
+        return rtt
+    return srtt + (rtt - srtt) / 8.0
+
+
 class SessionKeepAliveParams:
     def __init__(self, idle_time=30, interval=10, probes=3, ping_id='keep_alive_ping', pong_id='keep_alive_pong'):
         self.idle_time = idle_time
@@ -246,22 +735,391 @@ class SessionKeepAliveParams:
         self.pong_id = pong_id
 
 
+class SessionRpcParams:
+    """Session.call sends request_id messages and the peer answers with reply_id messages"""
+    def __init__(self, timeout=30, request_id='rpc_request', reply_id='rpc_reply'):
+        self.timeout = timeout
+        self.request_id = request_id
+        self.reply_id = reply_id
+
+
+class SessionFlowControlParams:
+    """
+    When the pending output of a session reaches high_watermark bytes, on_send_buffer_full is called and
+    reading from the peer is paused(if pause_reading) until it drains to low_watermark, meanwhile policy:
+        'queue' - still queue messages
+        'drop' - drop messages, send_message returns False and is_send_buffer_full() is True
+        'disconnect' - close the session with ERROR_SEND_BUFFER_OVERFLOW
+    """
+    def __init__(self, high_watermark=1024 * 1024, low_watermark=256 * 1024, pause_reading=True, policy='queue'):
+        if policy not in ('queue', 'drop', 'disconnect'):
+            raise ValueError("policy must be 'queue', 'drop' or 'disconnect'")
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.pause_reading = pause_reading
+        self.policy = policy
+
+
+class SessionStreamParams:
+    """
+    Session.send_stream splits data into fragments of fragment_size bytes sent as fragment_id messages,
+    the receiver reassembles at most max_stream_size bytes for a normal handler
+    """
+    def __init__(self, fragment_size=8 * 1024, max_stream_size=64 * 1024 * 1024, fragment_id='stream_fragment'):
+        self.fragment_size = fragment_size
+        self.max_stream_size = max_stream_size
+        self.fragment_id = fragment_id
+
+
+class SessionCompressionParams:
+    """
+    zlib compression of frames of at least threshold bytes, negotiated when a SessionC opens: it sends hello,
+    the SessionS replies ack, then the SessionC acks back. Each side flags and compresses its frames after
+    sending its ack, and decodes flagged frames after receiving the ack of the peer. dictionary is an optional
+    preset zlib dictionary(e.g. concatenated message samples), both sides must use the same one.
+    """
+    def __init__(self, threshold=1024, level=6, dictionary=None, hello_id='compression_hello', ack_id='compression_ack'):
+        self.threshold = threshold
+        self.level = level
+        self.dictionary = dictionary
+        self.dictionary_id = zlib.adler32(dictionary) & 0xffffffff if dictionary else 0
+        self.hello_id = hello_id
+        self.ack_id = ack_id
+        self._compressor = None  # primed with the dictionary, copied for every frame
+        self._decompressor = None
+
+    def compress(self, data):
+        if not self.dictionary:
+            return zlib.compress(data, self.level)
+        if self._compressor is None:
+            self._compressor = zlib.compressobj(self.level, zlib.DEFLATED, zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL,
+                                                zlib.Z_DEFAULT_STRATEGY, zdict=self.dictionary)
+        compressor = self._compressor.copy()
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data, max_size):
+        if not self.dictionary:
+            decompressor = zlib.decompressobj()
+        else:
+            if self._decompressor is None:
+                self._decompressor = zlib.decompressobj(zlib.MAX_WBITS, zdict=self.dictionary)
+            decompressor = self._decompressor.copy()
+        result = decompressor.decompress(data, max_size)
+        if decompressor.unconsumed_tail or not decompressor.eof:
+            raise ValueError('compressed frame is truncated or exceeds %d bytes' % max_size)
+        return result
+
+
+_FRAME_RAW = b'\x00'[0]  # flag byte leading the frames of a compression negotiated session
+_FRAME_COMPRESSED = b'\x01'[0]
+
+
+class Metrics:
+    """
+    Message/byte counters per msg_id and per session, handler calls and latency histograms,
+    and close reasons of the sessions of a runner. Sessions only pay a None check when disabled.
+    """
+    HISTOGRAM_SIZE = 32  # bucket i counts latencies below 2**i microseconds
+
+    def __init__(self):
+        self._messages_in = {}  # msg_id -> [count, bytes]
+        self._messages_out = {}
+        self._handlers = {}  # msg_id -> [calls, total seconds, histogram]
+        self._close_reasons = {}  # error name -> count
+
+    def on_recv(self, session, msg_id, size):
+        counter = self._messages_in.get(msg_id)
+        if counter is None:
+            counter = self._messages_in[msg_id] = [0, 0]
+        counter[0] += 1
+        counter[1] += size
+        session._metrics_counts[0] += 1
+        session._metrics_counts[1] += size
+
+    def on_send(self, session, msg_id, size):
+        counter = self._messages_out.get(msg_id)
+        if counter is None:
+            counter = self._messages_out[msg_id] = [0, 0]
+        counter[0] += 1
+        counter[1] += size
+        session._metrics_counts[2] += 1
+        session._metrics_counts[3] += size
+
+    def on_handled(self, msg_id, seconds):
+        handler = self._handlers.get(msg_id)
+        if handler is None:
+            handler = self._handlers[msg_id] = [0, 0.0, [0] * self.HISTOGRAM_SIZE]
+        handler[0] += 1
+        handler[1] += seconds
+        handler[2][min(int(seconds * 1000000).bit_length(), self.HISTOGRAM_SIZE - 1)] += 1
+
+    def on_closed(self, session):
+        name = Error.BASE_STR_ERROR_MAP.get(session.get_error().get_error(), 'unknown')
+        self._close_reasons[name] = self._close_reasons.get(name, 0) + 1
+
+    def clear(self):
+        self.__init__()
+
+    def snapshot(self, sessions=()):
+        """Plain dict copy of all counters, sessions are the live sessions to report"""
+        return {
+            'messages_in': dict((k, {'count': v[0], 'bytes': v[1]}) for k, v in self._messages_in.items()),
+            'messages_out': dict((k, {'count': v[0], 'bytes': v[1]}) for k, v in self._messages_out.items()),
+            'handlers': dict((k, {
+                'calls': v[0],
+                'total_us': v[1] * 1000000,
+                'latency_us': dict((1 << i, n) for i, n in enumerate(v[2]) if n > 0),  # upper bound -> count
+            }) for k, v in self._handlers.items()),
+            'close_reasons': dict(self._close_reasons),
+            'sessions': dict((session.get_serial(), {
+                'in_count': session._metrics_counts[0],
+                'in_bytes': session._metrics_counts[1],
+                'out_count': session._metrics_counts[2],
+                'out_bytes': session._metrics_counts[3],
+                'out_buffer': len(session._out_buffer),
+            }) for session in sessions if session._metrics is not None),
+        }
+
+
+class Watchdog:
+    """
+    Log run_once iterations and message handlers running longer than their thresholds(seconds),
+    with the msg_id, the handler name and the session. If sample_stack is True, a side thread logs
+    the loop thread stack once while a handler is still running beyond handler_threshold.
+    """
+    def __init__(self, loop_threshold=0.1, handler_threshold=0.05, sample_stack=False, sample_interval=None):
+        self.loop_threshold = loop_threshold
+        self.handler_threshold = handler_threshold
+        self.sample_stack = sample_stack
+        self.sample_interval = handler_threshold / 2.0 if sample_interval is None else sample_interval
+
+        self._current = None  # (start time, session, msg_id, loop thread id) of the running handler
+        self._sampled = None  # the _current whose stack was logged
+        self._stop_event = None
+        self._thread = None
+
+    def start(self):
+        if self.sample_stack and self._thread is None:
+            self._stop_event = threading.Event()
+            self._thread = threading.Thread(target=self._sample_loop, name='asynmsg-watchdog')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop_event.set()
+            self._thread.join()
+            self._thread = None
+
+    def on_iteration(self, seconds):
+        if seconds > self.loop_threshold:
+            logger.warning('run_once took %.3fms, threshold %.3fms', seconds * 1000, self.loop_threshold * 1000)
+
+    def begin_handler(self, session, msg_id):
+        self._current = (_perf_counter(), session, msg_id, _get_thread_ident())
+
+    def end_handler(self):
+        current = self._current
+        self._current = None
+        seconds = _perf_counter() - current[0]
+        if seconds > self.handler_threshold:
+            logger.warning('%s slow handler %s of message(%s) took %.3fms, threshold %.3fms',
+                           self._describe(current[1]), self._handler_name(current[1], current[2]), current[2],
+                           seconds * 1000, self.handler_threshold * 1000)
+
+    def _sample_loop(self):
+        while not self._stop_event.wait(self.sample_interval):
+            current = self._current
+            if current is None or current is self._sampled:
+                continue
+            seconds = _perf_counter() - current[0]
+            if seconds <= self.handler_threshold:
+                continue
+            frame = sys._current_frames().get(current[3])
+            if frame is None:
+                continue
+            self._sampled = current
+            logger.warning('%s handler %s of message(%s) still running after %.3fms, stack:\n%s',
+                           self._describe(current[1]), self._handler_name(current[1], current[2]), current[2],
+                           seconds * 1000, ''.join(traceback.format_stack(frame)))
+
+    @staticmethod
+    def _handler_name(session, msg_id):
+        handler = session.__class__._command_factory.get(msg_id)
+        if handler is None:
+            return 'on_unhandled_message'
+        return getattr(handler, '__qualname__', handler.__name__)
+
+    @staticmethod
+    def _describe(session):
+        try:
+            return session.get_low_level_desc()
+        except Exception:  # closed inside the handler
+            return '%s(%d)' % (session.__class__.__name__, session.get_serial())
+
+
+_get_thread_ident = getattr(threading, 'get_ident', None) or threading._get_ident
+_watchdog = None
+
+
+def set_watchdog(watchdog):
+    """Install a Watchdog for the loop, None to remove"""
+    global _watchdog
+    if _watchdog is not None:
+        _watchdog.stop()
+    _watchdog = watchdog
+    if watchdog is not None:
+        watchdog.start()
+
+
+def get_watchdog():
+    return _watchdog
+
+
+class Profiler:
+    """
+    Sampling cost table per msg_id: time of message_packer.unpack, of the handler itself, and of the
+    message_packer.pack_segments calls the handler makes(send_message, broadcast...). One of every sample_every
+    dispatches of each msg_id is measured, unpack is measured on randomly one of sample_every frames.
+    """
+    # row: [dispatches, unpack samples, unpack seconds, handler samples, handler seconds, pack calls, pack seconds]
+
+    def __init__(self, sample_every=100):
+        self.sample_every = sample_every
+        self._table = {}  # msg_id -> row
+        self._unpack_countdown = 1
+        self._current = None  # row of the sampled handler running
+        self._pack_time = 0.0
+        self._pack_calls = 0
+
+    def clear(self):
+        self._table = {}
+        self._unpack_countdown = 1
+
+    def _get_row(self, msg_id):
+        row = self._table.get(msg_id)
+        if row is None:
+            row = self._table[msg_id] = [0, 0, 0.0, 0, 0.0, 0, 0.0]
+        return row
+
+    def sample_unpack(self):
+        self._unpack_countdown -= 1
+        if self._unpack_countdown > 0:
+            return False
+        self._unpack_countdown = random.randint(1, 2 * self.sample_every - 1)  # avoid aliasing with periodic traffic
+        return True
+
+    def on_unpack(self, pair, seconds):
+        row = self._get_row(pair[0] if _is_valid_message_format(pair) else None)
+        row[1] += 1
+        row[2] += seconds
+
+    def begin_handler(self, msg_id):
+        """:return the row if this dispatch is sampled, else None"""
+        row = self._get_row(msg_id)
+        row[0] += 1
+        if (row[0] - 1) % self.sample_every != 0:
+            return None
+        self._current = row
+        self._pack_time = 0.0
+        self._pack_calls = 0
+        return row
+
+    def end_handler(self, row, seconds):
+        self._current = None
+        row[3] += 1
+        row[4] += seconds - self._pack_time
+        row[5] += self._pack_calls
+        row[6] += self._pack_time
+
+    def on_pack(self, seconds):
+        self._pack_calls += 1
+        self._pack_time += seconds
+
+    def snapshot(self):
+        """msg_id -> mean microseconds per dispatch of each phase, and the estimated total cost"""
+        result = {}
+        for msg_id, row in self._table.items():
+            unpack_us = row[2] / row[1] * 1000000 if row[1] > 0 else 0
+            handler_us = row[4] / row[3] * 1000000 if row[3] > 0 else 0
+            pack_us = row[6] / row[3] * 1000000 if row[3] > 0 else 0
+            result[msg_id] = {
+                'dispatches': row[0],
+                'samples': row[3],
+                'unpack_us': unpack_us,
+                'handler_us': handler_us,
+                'pack_us': pack_us,
+                'pack_calls': float(row[5]) / row[3] if row[3] > 0 else 0,
+                'total_ms': (unpack_us + handler_us + pack_us) * row[0] / 1000,
+            }
+        return result
+
+    def format_table(self):
+        lines = ['%-24s %10s %8s %10s %10s %10s %8s %12s' % (
+            'msg_id', 'dispatches', 'samples', 'unpack_us', 'handler_us', 'pack_us', 'packs', 'total_ms')]
+        snapshot = self.snapshot()
+        for msg_id, cost in sorted(snapshot.items(), key=lambda item: -item[1]['total_ms']):
+            lines.append('%-24s %10d %8d %10.2f %10.2f %10.2f %8.2f %12.3f' % (
+                msg_id, cost['dispatches'], cost['samples'], cost['unpack_us'], cost['handler_us'],
+                cost['pack_us'], cost['pack_calls'], cost['total_ms']))
+        return '\n'.join(lines)
+
+    def log_table(self):
+        logger.info('message cost table:\n%s', self.format_table())
+
+    def install_signal(self, signum=None):
+        """Log the cost table in the loop thread when signum(default SIGUSR2) is received"""
+        if signum is None:
+            signum = getattr(signal, 'SIGUSR2', None)
+            if signum is None:
+                raise ValueError('no SIGUSR2 on this platform, pass signum to install_signal')
+        signal.signal(signum, lambda signum, frame: _call_soon_threadsafe(self.log_table))
+
+
+_profiler = None
+
+
+def set_profiler(profiler):
+    """Install a Profiler for all sessions, None to remove"""
+    global _profiler
+    _profiler = profiler
+
+
+def get_profiler():
+    return _profiler
+
+
 class MessagePacker:
+    keeps_views = False  # True if unpacked messages may keep views into the receive buffer
+
     def __init__(self, size_fmt='H'):
         self._size_fmt = size_fmt
+        self._size_struct = struct.Struct(size_fmt)
 
     def pack(self, msg_id, msg_data):
         """ Pack to bytes, msg_data may be any type(including None)"""
         raise NotImplementedError
 
+    def pack_segments(self, msg_id, msg_data):
+        """Pack to a list of byte buffers sent one after another, used by sessions instead of pack"""
+        return [self.pack(msg_id, msg_data)]
+
     def unpack(self, bytes):
-        """Unpack to pair of (msg_id, msg_data)"""
+        """
+        Unpack to pair of (msg_id, msg_data)
+        bytes is a memoryview into the session receive buffer, copy what should outlive this call
+        """
         raise NotImplementedError
 
     @property
     def size_fmt(self):
         return self._size_fmt
 
+    @property
+    def size_struct(self):
+        """Precompiled struct.Struct of size_fmt"""
+        return self._size_struct
+
 
 class MessagePacker_Pickle(MessagePacker):
     def __init__(self, size_fmt='H'):
@@ -274,23 +1132,368 @@ class MessagePacker_Pickle(MessagePacker):
         return pickle.loads(bytes)
 
 
+_OUT_OF_BAND_TYPES = {bytes: 0, bytearray: 1, memoryview: 2}
+_OUT_OF_BAND_HEAD = struct.Struct('<IH')  # pickle length, buffer count
+
+
+def _rebuild_out_of_band(buffer, kind):
+    """Called by pickle.loads for values packed out of band by MessagePacker_Pickle5, buffer is a frame view"""
+    if kind == 0:
+        return bytes(buffer)
+    if kind == 1:
+        return bytearray(buffer)
+    return buffer
+
+
+class _OutOfBand:
+    """Pickled as _rebuild_out_of_band(PickleBuffer, kind) so the buffer goes out of band"""
+    __slots__ = ('value', 'kind')
+
+    def __init__(self, value, kind):
+        self.value = value
+        self.kind = kind
+
+    def __reduce_ex__(self, protocol):
+        return _rebuild_out_of_band, (pickle.PickleBuffer(self.value), self.kind)
+
+
+class MessagePacker_Pickle5(MessagePacker_Pickle):
+    """
+    Pickle protocol 5 with out-of-band buffers: PickleBuffer values, and bytes, bytearray or memoryview
+    values of at least oob_threshold bytes in msg_data or directly in its tuple, list or dict, are framed
+    after the pickle stream instead of copied into it, and sent without copy(so must not be modified until
+    sent). bytes and bytearray are copied out of the frame when received, memoryview and PickleBuffer are
+    received as read-only views of the receive buffer without copy.
+    """
+    keeps_views = True
+
+    def __init__(self, size_fmt='I', oob_threshold=64 * 1024):
+        super(MessagePacker_Pickle5, self).__init__(size_fmt)
+        if getattr(pickle, 'HIGHEST_PROTOCOL', 0) < 5:
+            raise NotImplementedError('pickle protocol 5 is not supported')
+        self._oob_threshold = oob_threshold
+
+    def pack(self, msg_id, msg_data):
+        return b''.join(self.pack_segments(msg_id, msg_data))
+
+    def pack_segments(self, msg_id, msg_data):
+        buffers = []
+        stream = pickle.dumps((msg_id, self._wrap(msg_data)), 5, buffer_callback=buffers.append)
+        views = [buffer.raw() for buffer in buffers]
+        head = _OUT_OF_BAND_HEAD.pack(len(stream), len(views))
+        if views:
+            head += struct.pack('<%dI' % len(views), *[len(view) for view in views])
+        return [head + stream] + views
+
+    def unpack(self, bytes):
+        stream_length, count = _OUT_OF_BAND_HEAD.unpack_from(bytes)
+        offset = _OUT_OF_BAND_HEAD.size
+        lengths = struct.unpack_from('<%dI' % count, bytes, offset)
+        offset += 4 * count
+        stream = bytes[offset:offset + stream_length]
+        offset += stream_length
+        buffers = []
+        for length in lengths:
+            buffers.append(bytes[offset:offset + length].toreadonly())
+            offset += length
+        if offset != len(bytes):
+            raise ValueError('out of band buffers size mismatch')
+        return pickle.loads(stream, buffers=buffers)
+
+    def _wrap(self, value):
+        if type(value) is tuple:
+            return tuple([self._wrap_item(item) for item in value])
+        if type(value) is list:
+            return [self._wrap_item(item) for item in value]
+        if type(value) is dict:
+            return dict((key, self._wrap_item(item)) for key, item in value.items())
+        return self._wrap_item(value)
+
+    def _wrap_item(self, value):
+        kind = _OUT_OF_BAND_TYPES.get(type(value))
+        if kind is None:
+            return value
+        if kind == 2:  # memoryview can only be pickled out of band
+            return _OutOfBand(value if value.contiguous else value.tobytes(), kind)
+        if len(value) >= self._oob_threshold:
+            return _OutOfBand(value, kind)
+        return value
+
+
 class MessagePacker_Struct(MessagePacker):
     def __init__(self, size_fmt='H', id_fmt='H'):
         super(MessagePacker_Struct, self).__init__(size_fmt)
         self._id_fmt = id_fmt
+        self._id_struct = struct.Struct(id_fmt)
 
     def pack(self, msg_id, msg_data):
-        bytes = struct.pack(self._id_fmt, msg_id)
+        bytes = self._id_struct.pack(msg_id)
         if msg_data is not None:
             bytes += msg_data
         return bytes
 
     def unpack(self, bytes):
-        msg_id = struct.unpack_from(self._id_fmt, bytes)[0]
-        msg_data = bytes[2:]
+        msg_id = self._id_struct.unpack_from(bytes)[0]
+        msg_data = BinaryType(bytes[self._id_struct.size:])
         return (msg_id, msg_data)
 
 
+_SCHEMA_SCALAR_CODES = 'bBhHiIqQfd?'
+
+
+def _is_schema_scalar(spec):
+    return isinstance(spec, str) and len(spec) == 1 and spec in _SCHEMA_SCALAR_CODES
+
+
+def _is_schema_record(spec):
+    return isinstance(spec, list) and len(spec) > 0 and \
+        all(isinstance(field, tuple) and len(field) == 2 for field in spec)
+
+
+class _SchemaCompiler:
+    """Generate python source of the pack/unpack functions of field specs, compiled once by exec"""
+    def __init__(self, byte_order, length_code):
+        self._byte_order = byte_order
+        self._length_code = length_code
+        self._name_count = 0
+        self._structs = {}  # format -> name in namespace
+        self.namespace = {
+            'struct_pack': struct.pack,
+            'struct_unpack_from': struct.unpack_from,
+            'utf8_decode': codecs.utf_8_decode,
+            'Struct': struct.Struct,
+        }
+
+    def compile(self, id_bytes, spec):
+        """:return (pack(msg_data) -> bytes, unpack(bytes) -> msg_data), unpack starts after the msg_id"""
+        pack_name, unpack_name = self._new_name('pack'), self._new_name('unpack')
+        self.namespace[pack_name + '_id'] = id_bytes
+
+        lines = ['def %s(value):' % pack_name, '    parts = [%s_id]' % pack_name, '    p = parts.append']
+        if spec is not None:
+            self._encode(spec, 'value', lines, 1)
+        lines.append("    return b''.join(parts)")
+
+        lines += ['def %s(b):' % unpack_name, '    size = len(b)', '    o = %d' % len(id_bytes)]
+        k = 0
+        if spec is None:
+            lines.append('    value = None')
+        else:
+            k = self._decode(spec, 'value', lines, 1)
+        lines += ['    if %s != size:' % self._offset(k), "        raise ValueError('message size mismatch schema')", '    return value']
+
+        exec(compile('\n'.join(lines), '<asynmsg schema>', 'exec'), self.namespace)
+        return self.namespace[pack_name], self.namespace[unpack_name]
+
+    def _new_name(self, prefix='v'):
+        self._name_count += 1
+        return '%s%d' % (prefix, self._name_count)
+
+    def _struct(self, codes):
+        fmt = self._byte_order + codes
+        name = self._structs.get(fmt)
+        if name is None:
+            name = self._structs[fmt] = self._new_name('S')
+            self.namespace[name] = struct.Struct(fmt)
+        return name
+
+    def _record_steps(self, spec):
+        """Consecutive scalar fields of a record share one struct: [(names tuple, codes) or (name, spec)]"""
+        steps = []
+        for name, field_spec in spec:
+            if not _is_schema_scalar(field_spec):
+                steps.append((name, field_spec))
+            elif steps and isinstance(steps[-1][0], tuple):
+                steps[-1] = (steps[-1][0] + (name,), steps[-1][1] + field_spec)
+            else:
+                steps.append(((name,), field_spec))
+        return steps
+
+    def _is_fixed_record(self, spec):
+        return _is_schema_record(spec) and all(_is_schema_scalar(field_spec) for _, field_spec in spec)
+
+    def _sized_step(self, steps, index):
+        """If the scalar group steps[index] is followed by str/bytes, its length is packed together with the group"""
+        return index + 1 < len(steps) and steps[index + 1][1] in ('str', 'bytes')
+
+    def _encode(self, spec, expr, lines, indent):
+        """Lines appending the packed bytes of expression expr by p"""
+        pad = '    ' * indent
+        if _is_schema_scalar(spec):
+            lines.append('%sp(%s.pack(%s))' % (pad, self._struct(spec), expr))
+        elif spec == 'str' or spec == 'bytes':
+            value = self._encode_sized(spec, expr, lines, pad)
+            lines.append('%sp(%s.pack(len(%s)))' % (pad, self._struct(self._length_code), value))
+            lines.append('%sp(%s)' % (pad, value))
+        elif _is_schema_record(spec):
+            value = self._new_name()
+            lines.append('%s%s = %s' % (pad, value, expr))
+            steps = self._record_steps(spec)
+            sized = None  # encoded str/bytes whose length was packed with the previous group
+            for index, (name, field_spec) in enumerate(steps):
+                if isinstance(name, tuple):
+                    args = ['%s[%r]' % (value, x) for x in name]
+                    if self._sized_step(steps, index):
+                        sized = self._encode_sized(steps[index + 1][1], '%s[%r]' % (value, steps[index + 1][0]), lines, pad)
+                        args.append('len(%s)' % sized)
+                        field_spec += self._length_code
+                    lines.append('%sp(%s.pack(%s))' % (pad, self._struct(field_spec), ', '.join(args)))
+                elif sized is not None:
+                    lines.append('%sp(%s)' % (pad, sized))
+                    sized = None
+                else:
+                    self._encode(field_spec, '%s[%r]' % (value, name), lines, indent)
+        elif isinstance(spec, list) and len(spec) == 1:
+            value = self._new_name()
+            lines.append('%s%s = %s' % (pad, value, expr))
+            if _is_schema_scalar(spec[0]):
+                lines.append("%sp(struct_pack('%s%s%%d%s' %% len(%s), len(%s), *%s))" % (
+                    pad, self._byte_order, self._length_code, spec[0], value, value, value))
+            elif self._is_fixed_record(spec[0]):
+                element = self._new_name()
+                codes = ''.join(field_spec for _, field_spec in spec[0])
+                lines.append('%sp(%s.pack(len(%s)))' % (pad, self._struct(self._length_code), value))
+                lines.append("%sp(b''.join([%s.pack(%s) for %s in %s]))" % (
+                    pad, self._struct(codes), ', '.join('%s[%r]' % (element, name) for name, _ in spec[0]), element, value))
+            else:
+                element = self._new_name()
+                lines.append('%sp(%s.pack(len(%s)))' % (pad, self._struct(self._length_code), value))
+                lines.append('%sfor %s in %s:' % (pad, element, value))
+                self._encode(spec[0], element, lines, indent + 1)
+        else:
+            raise ValueError('invalid schema field spec: %r' % (spec,))
+
+    def _encode_sized(self, spec, expr, lines, pad):
+        value = self._new_name()
+        lines.append('%s%s = %s%s' % (pad, value, expr, ".encode('utf-8')" if spec == 'str' else ''))
+        return value
+
+    @staticmethod
+    def _offset(k):
+        return 'o' if k == 0 else 'o + %d' % k
+
+    def _decode(self, spec, target, lines, indent, k=0):
+        """
+        Lines decoding buffer b at offset o + k to variable target, k is a constant not added to o yet
+        :return the constant to add to o after the decoded value
+        """
+        pad = '    ' * indent
+        if _is_schema_scalar(spec):
+            lines.append('%s%s, = %s.unpack_from(b, %s)' % (pad, target, self._struct(spec), self._offset(k)))
+            return k + struct.calcsize(self._byte_order + spec)
+        elif spec == 'str' or spec == 'bytes':
+            length = self._new_name()
+            k = self._decode(self._length_code, length, lines, indent, k)
+            return self._decode_sized(spec, target, length, lines, pad, k)
+        elif _is_schema_record(spec):
+            items = []
+            steps = self._record_steps(spec)
+            length = None  # of the str/bytes unpacked with the previous group
+            for index, (name, field_spec) in enumerate(steps):
+                if isinstance(name, tuple):
+                    values = [self._new_name() for _ in name]
+                    items += zip(name, values)
+                    if self._sized_step(steps, index):
+                        length = self._new_name()
+                        values.append(length)
+                        field_spec += self._length_code
+                    lines.append('%s%s, = %s.unpack_from(b, %s)' % (pad, ', '.join(values), self._struct(field_spec), self._offset(k)))
+                    k += struct.calcsize(self._byte_order + field_spec)
+                else:
+                    value = self._new_name()
+                    items.append((name, value))
+                    if length is not None:
+                        k = self._decode_sized(field_spec, value, length, lines, pad, k)
+                        length = None
+                    else:
+                        k = self._decode(field_spec, value, lines, indent, k)
+            lines.append('%s%s = {%s}' % (pad, target, ', '.join('%r: %s' % item for item in items)))
+            return k
+        elif isinstance(spec, list) and len(spec) == 1:
+            count = self._new_name()
+            k = self._decode(self._length_code, count, lines, indent, k)
+            if k and not self._is_fixed_record(spec[0]):
+                lines.append('%so += %d' % (pad, k))
+                k = 0
+            if _is_schema_scalar(spec[0]):
+                # structs of small counts are cached
+                cache, counted = self._new_name('C'), self._new_name()
+                self.namespace[cache] = {}
+                lines.append('%s%s = %s.get(%s)' % (pad, counted, cache, count))
+                lines.append('%sif %s is None:' % (pad, counted))
+                lines.append("%s    %s = Struct('%s%%d%s' %% %s)" % (pad, counted, self._byte_order, spec[0], count))
+                lines.append('%s    if %s < 256:' % (pad, count))
+                lines.append('%s        %s[%s] = %s' % (pad, cache, count, counted))
+                lines.append('%s%s = list(%s.unpack_from(b, o))' % (pad, target, counted))
+                lines.append('%so += %s.size' % (pad, counted))
+            elif self._is_fixed_record(spec[0]):
+                codes = ''.join(field_spec for _, field_spec in spec[0])
+                item_struct = self._struct(codes)
+                end = self._new_name()
+                values = [self._new_name() for _ in spec[0]]
+                lines.append('%s%s = %s + %s * %d' % (pad, end, self._offset(k), count, struct.calcsize(self._byte_order + codes)))
+                lines.append('%sif %s > size:' % (pad, end))
+                lines.append("%s    raise ValueError('truncated message')" % pad)
+                lines.append('%s%s = [{%s} for %s, in %s.iter_unpack(b[%s:%s])]' % (
+                    pad, target, ', '.join('%r: %s' % (name, value) for (name, _), value in zip(spec[0], values)),
+                    ', '.join(values), item_struct, self._offset(k), end))
+                lines.append('%so = %s' % (pad, end))
+            else:
+                element = self._new_name()
+                lines.append('%s%s = []' % (pad, target))
+                lines.append('%sfor _ in range(%s):' % (pad, count))
+                element_k = self._decode(spec[0], element, lines, indent + 1)
+                if element_k:
+                    lines.append('%s    o += %d' % (pad, element_k))
+                lines.append('%s    %s.append(%s)' % (pad, target, element))
+            return 0
+        else:
+            raise ValueError('invalid schema field spec: %r' % (spec,))
+
+    def _decode_sized(self, spec, target, length, lines, pad, k):
+        """Lines decoding str/bytes of length at o + k to target"""
+        end = self._new_name()
+        lines.append('%s%s = %s + %s' % (pad, end, self._offset(k), length))
+        lines.append('%sif %s > size:' % (pad, end))
+        lines.append("%s    raise ValueError('truncated message')" % pad)
+        if spec == 'str':
+            lines.append('%s%s = utf8_decode(b[%s:%s], None, True)[0]' % (pad, target, self._offset(k), end))
+        else:
+            lines.append('%s%s = bytes(b[%s:%s])' % (pad, target, self._offset(k), end))
+        lines.append('%so = %s' % (pad, end))
+        return 0
+
+
+class MessagePacker_Schema(MessagePacker):
+    """
+    Binary packer driven by a schema of msg_id -> field spec, each spec is compiled once:
+        'b' 'B' 'h' 'H' 'i' 'I' 'q' 'Q' 'f' 'd' '?'  - struct scalar
+        'str' 'bytes'                                 - length prefixed utf-8 text / bytes
+        [spec]                                        - list of spec
+        [(name, spec), ...]                           - record, encoded from and decoded to dict
+        None                                          - no data, msg_data must be None
+    Lengths and counts use size_fmt, msg_id uses id_fmt.
+    Frames are 2-3 times smaller than MessagePacker_Pickle. Speed is about the same as the C pickle(CPython 3.11):
+    a flat record packs in 0.6us and unpacks in 0.9us(pickle 0.8/1.0), 20 fixed records in 3.7/5.9us(pickle 3.7/5.5),
+    records mixing str, lists and bytes are up to 1.6 times slower, building the dicts dominates decoding.
+    """
+    def __init__(self, schema, size_fmt='H', id_fmt='H', byte_order='<'):
+        super(MessagePacker_Schema, self).__init__(size_fmt)
+        self._id_struct = struct.Struct(byte_order + id_fmt)
+        compiler = _SchemaCompiler(byte_order, size_fmt.lstrip('@=<>!'))
+        self._packers = {}  # msg_id -> pack function
+        self._unpackers = {}  # msg_id -> unpack function
+        for msg_id, spec in schema.items():
+            self._packers[msg_id], self._unpackers[msg_id] = compiler.compile(self._id_struct.pack(msg_id), spec)
+
+    def pack(self, msg_id, msg_data):
+        return self._packers[msg_id](msg_data)
+
+    def unpack(self, bytes):
+        msg_id = self._id_struct.unpack_from(bytes)[0]
+        return (msg_id, self._unpackers[msg_id](bytes))
+
+
 def with_message_handler_config(cls):
     # cls hasattr _command_factory if derived from a class which defined with_message_handler_config
     if not hasattr(cls, '_command_factory'):
@@ -299,10 +1502,19 @@ def with_message_handler_config(cls):
         if cls.keep_alive_params is not None:
             def _on_keep_alive_ping(self, msg_id, msg_data):
                 self.send_message(cls.keep_alive_params.pong_id, None)
-            def _on_keep_alive_pong(self, msg_id, msg_data):
-                pass
             cls.register_command_handler(cls.keep_alive_params.ping_id, _on_keep_alive_ping)
-            cls.register_command_handler(cls.keep_alive_params.pong_id, _on_keep_alive_pong)
+            cls.register_command_handler(cls.keep_alive_params.pong_id, _Session._on_keep_alive_pong)
+
+        if cls.stream_params is not None:
+            cls.register_command_handler(cls.stream_params.fragment_id, _Session._on_stream_fragment)
+
+        if cls.rpc_params is not None:
+            cls.register_command_handler(cls.rpc_params.request_id, _Session._on_rpc_request)
+            cls.register_command_handler(cls.rpc_params.reply_id, _Session._on_rpc_reply)
+
+        if cls.compression_params is not None:
+            cls.register_command_handler(cls.compression_params.hello_id, _Session._on_compression_hello)
+            cls.register_command_handler(cls.compression_params.ack_id, _Session._on_compression_ack)
 
     order_map = {}
 
@@ -324,11 +1536,30 @@ def with_message_handler_config(cls):
 
 
 class message_handler_config:
+    """
+    :param executor None - run the handler inline in the loop
+        'thread' - run handler(self, msg_id, msg_data) in the thread pool, it should not call send_message
+        'process' - run handler(msg_id, msg_data) in the process pool, so it must be picklable(no self)
+        the result is delivered back in the loop thread to the callback, and messages received by the session
+        meanwhile are held, so the handling order of a session is kept
+    :param callback method name(or function) called as callback(self, msg_id, result) in the loop thread,
+        if None the result is treated like the return value of an inline handler(False means error),
+        for a request sent by call, the callback can answer it by reply
+    :param stream if True, the handler consumes a message sent by send_stream fragment by fragment, called as
+        handler(self, msg_id, fragment, last), else it is called once with the reassembled bytes
+    """
     total_count = 0
 
-    def __init__(self, msg_id, allow_override=True):
+    def __init__(self, msg_id, allow_override=True, executor=None, callback=None, stream=False):
+        if executor not in (None, 'thread', 'process'):
+            raise ValueError("executor must be None, 'thread' or 'process'")
+        if stream and executor is not None:
+            raise ValueError('stream handler must run inline')
         self.msg_id = msg_id
         self.allow_override = allow_override
+        self.executor = executor
+        self.callback = callback
+        self.stream = stream
         self.index = self.__class__.total_count
         self.__class__.total_count += 1
 
@@ -336,31 +1567,212 @@ class message_handler_config:
         func._message_handler_index = self.index
         func._message_handler_msg_id = self.msg_id
         func._message_handler_allow_override = self.allow_override
+        func._message_handler_executor = self.executor
+        func._message_handler_callback = self.callback
+        func._message_handler_stream = self.stream
         return func
 
 
-class AsynMsgDispatcher(asyncore.dispatcher):
-    def close(self):
-        asyncore.dispatcher.close(self)
-        self.socket = None
+_executors = {}
 
 
-class _Session(AsynMsgDispatcher):
-    message_packer = MessagePacker_Pickle()
-    keep_alive_params = SessionKeepAliveParams()  # set None to disable
-    max_message_size = 16 * 1024
-    max_send_size_once = 16 * 1024
-    max_recv_size_once = 16 * 1024
-    enable_nagle_algorithm = False
+def set_executor(kind, executor):
+    """Replace the concurrent.futures pool used by message handlers configured with executor=kind"""
+    _executors[kind] = executor
 
-    @classmethod
-    def register_command_handler(cls, cmd, handler):
-        if cmd in cls._command_factory:
-            old_handler = cls._command_factory[cmd]
-            if hasattr(old_handler,'_message_handler_allow_override') and old_handler._message_handler_allow_override:
-                cls._command_factory[cmd] = handler
-            else:
-                raise RuntimeError("Can't register message handler with duplicate id '%s'." % cmd)
+
+def _get_executor(kind):
+    executor = _executors.get(kind)
+    if executor is None:
+        import concurrent.futures
+        if kind == 'thread':
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=_cpu_count() * 5)
+        else:
+            executor = concurrent.futures.ProcessPoolExecutor()
+        _executors[kind] = executor
+    return executor
+
+
+_DISCONNECTED = frozenset((errno.ECONNRESET, errno.ENOTCONN, errno.ESHUTDOWN, errno.ECONNABORTED, errno.EPIPE, errno.EBADF))
+
+
+class _RecvBuffer:
+    """
+    Preallocated receive buffer, socket.recv_into writes at the end and consumed bytes only advance
+    the read offset. The unread tail is moved to the front only when there is not enough free room,
+    or to a new buffer if keep_consumed(consumed bytes may be still referenced by unpacked views).
+    """
+    def __init__(self, recv_size, keep_consumed=False):
+        self._recv_size = recv_size
+        self._keep_consumed = keep_consumed
+        self._buffer = None
+        self._view = None
+        self._start = 0
+        self._end = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    def reserve(self):
+        """Writable view of the free room, at most recv_size bytes"""
+        if self._buffer is None:
+            self._reallocate(self._recv_size)
+        elif len(self._buffer) - self._end < self._recv_size and self._start > 0:
+            if self._keep_consumed:
+                self._reallocate(len(self._buffer))
+            else:
+                size = self._end - self._start
+                self._buffer[:size] = self._buffer[self._start:self._end]
+                self._start = 0
+                self._end = size
+        if self._end == len(self._buffer):  # full of one incomplete message
+            self._reallocate(len(self._buffer) * 2)
+        return self._view[self._end:self._end + self._recv_size]
+
+    def commit(self, size):
+        self._end += size
+
+    def peek(self):
+        """View of the unread bytes, only valid until the next reserve"""
+        return self._view[self._start:self._end]
+
+    def consume(self, size):
+        self._start += size
+        if self._start == self._end and not self._keep_consumed:
+            self._start = 0
+            self._end = 0
+
+    def _reallocate(self, capacity):
+        buffer = bytearray(capacity)
+        size = self._end - self._start
+        if size > 0:
+            buffer[:size] = self._buffer[self._start:self._end]
+        self._buffer = buffer
+        self._view = memoryview(buffer)
+        self._start = 0
+        self._end = size
+
+
+class _SendQueue:
+    """
+    Queue of outgoing buffer segments drained with socket.sendmsg(writev semantics),
+    segments are sent as they are so they must not be modified after appended.
+    """
+    MAX_SEGMENTS_ONCE = 64
+    COALESCE_SIZE = 512  # small segments are cheaper to copy than to send as an extra iovec
+
+    def __init__(self):
+        self._segments = collections.deque()
+        self._offset = 0  # bytes already sent of the head segment
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def append(self, segment):
+        self._segments.append(segment)
+        self._size += len(segment)
+
+    def extend(self, segments):
+        for segment in segments:
+            self._segments.append(segment)
+            self._size += len(segment)
+
+    def peek(self, max_size):
+        """Segments to send, at most max_size bytes"""
+        result = []
+        total = 0
+        for segment in self._segments:
+            if not result and self._offset > 0:
+                segment = memoryview(segment)[self._offset:]
+            if total + len(segment) >= max_size:
+                result.append(memoryview(segment)[:max_size - total])
+                break
+            result.append(segment)
+            total += len(segment)
+            if len(result) == self.MAX_SEGMENTS_ONCE:
+                break
+        return result
+
+    def consume(self, size):
+        self._size -= size
+        size += self._offset
+        segments = self._segments
+        while segments and size >= len(segments[0]):
+            size -= len(segments.popleft())
+        self._offset = size
+
+
+class AsynMsgDispatcher(asyncore.dispatcher):
+    def add_channel(self, map=None):
+        asyncore.dispatcher.add_channel(self, map)
+        if _reactor is not None:
+            _reactor.add(self)
+
+    def del_channel(self, map=None):
+        if _reactor is not None:
+            _reactor.remove(self)
+        asyncore.dispatcher.del_channel(self, map)
+
+    def recv_into(self, buffer):
+        """Like asyncore.dispatcher.recv, but fill buffer and return the number of bytes received"""
+        try:
+            num = self.socket.recv_into(buffer)
+            if num == 0:
+                self.handle_close()
+            return num
+        except socket.error as why:
+            if why.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                return 0
+            if why.args[0] in _DISCONNECTED:
+                self.handle_close()
+                return 0
+            raise
+
+    def send_segments(self, segments):
+        """Like asyncore.dispatcher.send, but gather segments with sendmsg when supported"""
+        try:
+            if hasattr(self.socket, 'sendmsg'):
+                return self.socket.sendmsg(segments)
+            return self.socket.send(b''.join(segments))
+        except socket.error as why:
+            if why.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                return 0
+            if why.args[0] in _DISCONNECTED:
+                self.handle_close()
+                return 0
+            raise
+
+    def update_interest(self):
+        """Must be called when the result of readable()/writable() may change outside of an I/O event"""
+        if _reactor is not None:
+            _reactor.update(self)
+
+    def close(self):
+        asyncore.dispatcher.close(self)
+        self.socket = None
+
+
+class _Session(AsynMsgDispatcher):
+    message_packer = MessagePacker_Pickle()
+    keep_alive_params = SessionKeepAliveParams()  # set None to disable
+    compression_params = None  # SessionCompressionParams to enable
+    stream_params = SessionStreamParams()  # set None to disable send_stream
+    flow_control_params = None  # SessionFlowControlParams to bound the pending output
+    rpc_params = None  # SessionRpcParams to enable call
+    max_message_size = 16 * 1024
+    max_send_size_once = 16 * 1024
+    max_recv_size_once = 16 * 1024
+    enable_nagle_algorithm = False
+
+    @classmethod
+    def register_command_handler(cls, cmd, handler):
+        if cmd in cls._command_factory:
+            old_handler = cls._command_factory[cmd]
+            if hasattr(old_handler,'_message_handler_allow_override') and old_handler._message_handler_allow_override:
+                cls._command_factory[cmd] = handler
+            else:
+                raise RuntimeError("Can't register message handler with duplicate id '%s'." % cmd)
         cls._command_factory[cmd] = handler
 
     def __init__(self, sock, address):
@@ -369,22 +1781,61 @@ class _Session(AsynMsgDispatcher):
         self._manage_owner = None
 
         self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, not self.__class__.enable_nagle_algorithm)
-        self._error = Error()
+        self._dirty_map = None  # sessions of the manage owner(Server) to tick
+        self._error = _SessionError(self)
 
-        self._in_buffer = BinaryType()
-        self._out_buffer = BinaryType()
+        self._in_buffer = _RecvBuffer(self.__class__.max_recv_size_once, getattr(self.message_packer, 'keeps_views', False))
+        self._out_buffer = _SendQueue()
 
         self._last_read_time = time.time()
         self._keep_alive_probe_count = 0
+        self._keep_alive_timer = None
+        self._keep_alive_ping_time = None  # of the earliest unanswered ping
+        self._rtt = None
 
         self._force_close_time = -1
         self._force_wait_timeout = False
+        self._force_close_timer = None
 
         self._ready = True
+        self._ready_map = None  # ready sessions of the manage owner(Server), kept by set_ready
         self._serial = -1
+        self._topics = set()  # subscribed topics of the manage owner(Server)
+        self._index_keys = {}  # index name -> key in the indexes of the manage owner(Server)
+
+        self._metrics = None  # Metrics of the manage owner if enabled
+        self._metrics_counts = [0, 0, 0, 0]  # in count, in bytes, out count, out bytes
+
+        self._offload_busy = False  # an offloaded handler is running
+        self._offload_backlog = collections.deque()  # messages received meanwhile
+
+        self._send_compressed = False  # negotiated by compression_params
+        self._recv_compressed = False
+
+        self._out_streams = collections.deque()  # [msg_id, data, offset] being sent by send_stream, in order
+        self._in_stream = None  # [msg_id, fragments, size] being received
+
+        self._send_buffer_full = False  # between the high and low watermark of flow_control_params
+
+        self._next_call_id = 0
+        self._calls = {}  # call_id -> (RpcCall, timeout Timer)
+        self._call_context = None  # call_id of the request being handled
+
+        self._schedule_keep_alive()
 
     def close(self):
+        if self._keep_alive_timer is not None:
+            self._keep_alive_timer.cancel()
+            self._keep_alive_timer = None
+        if self._force_close_timer is not None:
+            self._force_close_timer.cancel()
+            self._force_close_timer = None
         AsynMsgDispatcher.close(self)
+        if self._calls:
+            calls, self._calls = self._calls, {}
+            for call, timer in calls.values():
+                timer.cancel()
+                call._complete(None, RpcError('session closed, error(%s)' % self._error))
 
     # close on no data to send or timeout, like linger
     # if force_wait_timeout is True, wait even if no data to send
@@ -392,11 +1843,27 @@ class _Session(AsynMsgDispatcher):
         self._force_close_time = time.time() + timeout
         self._force_wait_timeout = force_wait_timeout
 
+        if self._force_close_timer is not None:
+            self._force_close_timer.cancel()
+        if not force_wait_timeout and len(self._out_buffer) == 0:
+            self._force_close_timer = call_later(0, self._on_force_close_timer)
+        else:
+            self._force_close_timer = call_at(self._force_close_time, self._on_force_close_timer)
+
     def get_manage_owner(self):
         return self._manage_owner
 
+    def _mark_dirty(self):
+        if self._dirty_map is not None:
+            self._dirty_map[self._serial] = self
+
     def set_ready(self, ready=True):
         self._ready = ready
+        if self._ready_map is not None:
+            if ready:
+                self._ready_map[self._serial] = self
+            else:
+                self._ready_map.pop(self._serial, None)
 
     def is_ready(self):
         return self._ready
@@ -413,6 +1880,19 @@ class _Session(AsynMsgDispatcher):
     def get_serial(self):
         return self._serial
 
+    def get_rtt(self):
+        """Smoothed round trip time measured by keep alive ping/pong, None before the first pong"""
+        return self._rtt
+
+    def is_send_buffer_full(self):
+        return self._send_buffer_full
+
+    def is_send_compressed(self):
+        return self._send_compressed
+
+    def get_topics(self):
+        return self._topics
+
     def get_low_level_desc(self):
         local_addr = self.get_local_address()
         remote_addr = self.get_remote_address()
@@ -430,20 +1910,27 @@ class _Session(AsynMsgDispatcher):
     def on_closed(self):
         pass
 
-    def tick(self):
-        if not self._error.has_error():
-            if self._force_close_time > 0:
-                if (not self._force_wait_timeout and len(self._out_buffer) == 0) or self._force_close_time < time.time():
-                    self._error.set_error(Error.ERROR_FORCE_CLOSE)
+    def on_send_buffer_full(self):
+        """Pending output reached flow_control_params.high_watermark"""
+        logger.warning('%s send buffer full(%d bytes)', self.get_low_level_desc(), len(self._out_buffer))
 
-        if not self._error.has_error():
-            self._keep_alive_check()
+    def on_send_buffer_drained(self):
+        """Pending output drained to flow_control_params.low_watermark after on_send_buffer_full"""
+        pass
 
+    def tick(self):
+        # keep alive and force close are driven by timers
         if not self._error.has_error():
             self._unpack_and_handle_messages()
 
         return not self._error.has_error()
 
+    def get_next_deadline(self):
+        """The time when tick has something to do besides handling received data, None if no such time"""
+        if self._error.has_error():
+            return 0
+        return None
+
     """ <<< asyncore.dispatcher interfaces """
     def log(self, message):
         _wrapper_asyncore_log(message, 'info')
@@ -452,6 +1939,10 @@ class _Session(AsynMsgDispatcher):
         _wrapper_asyncore_log(message, type)
 
     def readable(self):
+        if self._send_buffer_full and self.__class__.flow_control_params.pause_reading:
+            return False
+        if self._offload_busy or self._offload_backlog:
+            return False  # TCP backpressure while an offloaded handler runs, the backlog stays bounded
         return not self._error.has_error()
 
     def writable(self):
@@ -461,19 +1952,28 @@ class _Session(AsynMsgDispatcher):
         if self._error.has_error():
             return
 
-        data = self.recv(self.__class__.max_recv_size_once)  # may handle_close inside
-        if data:
-            self._in_buffer += data
+        num = self.recv_into(self._in_buffer.reserve())  # may handle_close inside
+        if num > 0:
+            self._in_buffer.commit(num)
             self._last_read_time = time.time()
             self._keep_alive_probe_count = 0
+            self._mark_dirty()
 
     def handle_write(self):
         if self._error.has_error():
             return
 
-        num = self.send(self._out_buffer[:self.__class__.max_send_size_once])
+        num = self.send_segments(self._out_buffer.peek(self.__class__.max_send_size_once))
         if num > 0:
-            self._out_buffer = self._out_buffer[num:]
+            self._out_buffer.consume(num)
+            if self._send_buffer_full and len(self._out_buffer) <= self.__class__.flow_control_params.low_watermark:
+                self._send_buffer_full = False
+                self.update_interest()
+                self.on_send_buffer_drained()
+            if self._out_streams:
+                self._queue_stream_fragments()
+            if len(self._out_buffer) == 0 and self._force_close_time > 0 and not self._force_wait_timeout:
+                self._error.set_error(Error.ERROR_FORCE_CLOSE)
 
     def handle_close(self):  # use set_error if want to close manually
         if self._error.has_error():
@@ -486,9 +1986,20 @@ class _Session(AsynMsgDispatcher):
         handler = self.__class__._command_factory.get(msg_id)
         if handler is None:
             return self.on_unhandled_message(msg_id, msg_data)
+        elif getattr(handler, '_message_handler_stream', False):
+            logger.error('%s message(%s) of a stream handler not sent by send_stream', self.get_low_level_desc(), msg_id)
+            self._error.set_error(Error.ERROR_RECV_MESSAGE_FORMAT)
+            return False
+        elif getattr(handler, '_message_handler_executor', None) is not None:
+            return self._offload_message(handler, msg_id, msg_data)
         else:
             return handler(self, msg_id, msg_data)
 
+    def _on_invalid_system_message(self, msg_id, msg_data):
+        logger.error('%s invalid message(%s) format: %r', self.get_low_level_desc(), msg_id, msg_data)
+        self._error.set_error(Error.ERROR_RECV_MESSAGE_FORMAT)
+        return False
+
     def on_unhandled_message(self, msg_id, msg_data):
         logger.warning('%s unhandled message(%s)', self.get_low_level_desc(), msg_id)
 
@@ -497,21 +2008,147 @@ class _Session(AsynMsgDispatcher):
         if self._error.has_error() or self._force_close_time > 0:
             return False
 
-        byte_msg = self.message_packer.pack(msg_id, msg_data)
-        length = struct.calcsize(self.__class__.message_packer.size_fmt) + len(byte_msg)
+        return self.send_frame(self.pack_frame(msg_id, msg_data, self._send_compressed), msg_id)
 
-        if length > self.__class__.max_message_size:
-            raise MessageSizeOverflowError(msg_id, length, self.__class__.max_message_size)
+    def send_stream(self, msg_id, data):
+        """
+        Send bytes data of any size in fragments, queued only when the send buffer drains so messages sent meanwhile
+        are interleaved, streams of a session are sent one after another
+        """
+        if self._error.has_error() or self._force_close_time > 0:
+            return False
 
-        self._out_buffer += struct.pack(self.__class__.message_packer.size_fmt, length)
-        self._out_buffer += byte_msg
+        self._out_streams.append([msg_id, data, 0])
+        self._queue_stream_fragments()
         return True
 
+    def call(self, msg_id, msg_data=None, timeout=None, callback=None):
+        """
+        Send a request handled by the msg_id handler of the peer, which answers by reply or send_reply.
+        Many calls can be in flight, each fails with RpcTimeoutError after timeout(rpc_params.timeout if None)
+        :return RpcCall, callback(call) is added as its done callback
+        """
+        if self.__class__.rpc_params is None:
+            raise AsynMsgException('%s.rpc_params is None, set SessionRpcParams to call' % self.__class__.__name__)
+        call_id = self._next_call_id
+        self._next_call_id += 1
+        call = RpcCall(call_id, msg_id)
+        if callback is not None:
+            call.add_done_callback(callback)
+
+        if not self.send_message(self.__class__.rpc_params.request_id, (call_id, msg_id, msg_data)):
+            call._complete(None, RpcError('session closed or send buffer full, error(%s)' % self._error))
+            return call
+
+        if timeout is None:
+            timeout = self.__class__.rpc_params.timeout
+        call._session = self
+        self._calls[call_id] = (call, call_later(timeout, self._on_call_timeout, call_id))
+        return call
+
+    def get_call_context(self):
+        """Context of the request being handled(None if not a call), keep it to answer later by send_reply"""
+        return self._call_context
+
+    def reply(self, msg_data=None, error=None):
+        """Answer the request being handled, error(str) fails the call of the peer with RpcError"""
+        if self._call_context is None:
+            return False
+        return self.send_reply(self._call_context, msg_data, error)
+
+    def send_reply(self, context, msg_data=None, error=None):
+        return self.send_message(self.__class__.rpc_params.reply_id, (context, error, msg_data))
+
+    @classmethod
+    def pack_frame(cls, msg_id, msg_data, compressed=False):
+        """
+        Pack a message to a frame(list of buffers) which can be sent by send_frame to any session of this class
+        whose is_send_compressed() equals compressed
+        """
+        if _profiler is None or _profiler._current is None:
+            segments = cls.message_packer.pack_segments(msg_id, msg_data)
+        else:
+            start_time = _perf_counter()
+            segments = cls.message_packer.pack_segments(msg_id, msg_data)
+            _profiler.on_pack(_perf_counter() - start_time)
+        size_struct = cls.message_packer.size_struct
+
+        if compressed:
+            return cls._pack_compressed_frame(msg_id, segments)
+
+        if len(segments) > 1:  # out of band buffers, the packer guarantees they are immutable
+            length = size_struct.size + sum(len(segment) for segment in segments)
+            if length > cls.max_message_size:
+                raise MessageSizeOverflowError(msg_id, length, cls.max_message_size)
+            return [size_struct.pack(length) + segments[0]] + segments[1:]
+
+        byte_msg = segments[0]
+        length = size_struct.size + len(byte_msg)
+
+        if length > cls.max_message_size:
+            raise MessageSizeOverflowError(msg_id, length, cls.max_message_size)
+
+        if len(byte_msg) <= _SendQueue.COALESCE_SIZE:
+            return [size_struct.pack(length) + byte_msg]
+        if isinstance(byte_msg, bytearray):
+            byte_msg = bytes(byte_msg)  # queued without copy, so must be immutable
+        return [size_struct.pack(length), byte_msg]
+
+    @classmethod
+    def _pack_compressed_frame(cls, msg_id, segments):
+        size_struct = cls.message_packer.size_struct
+        byte_msg = segments[0] if len(segments) == 1 else b''.join(segments)
+        length = size_struct.size + 1 + len(byte_msg)
+        if length > cls.max_message_size:
+            raise MessageSizeOverflowError(msg_id, length, cls.max_message_size)
+
+        flag = b'\x00'
+        if len(byte_msg) >= cls.compression_params.threshold:
+            compressed_msg = cls.compression_params.compress(byte_msg)
+            if len(compressed_msg) < len(byte_msg):
+                byte_msg = compressed_msg
+                flag = b'\x01'
+                length = size_struct.size + 1 + len(byte_msg)
+
+        if len(byte_msg) <= _SendQueue.COALESCE_SIZE:
+            return [size_struct.pack(length) + flag + byte_msg]
+        if isinstance(byte_msg, bytearray):
+            byte_msg = bytes(byte_msg)
+        return [size_struct.pack(length) + flag, byte_msg]
+
+    def send_frame(self, frame, msg_id=None):
+        """Queue a frame made by pack_frame, the buffers are shared rather than copied"""
+        if self._error.has_error() or self._force_close_time > 0:
+            return False
+
+        if self._send_buffer_full and self.__class__.flow_control_params.policy == 'drop':
+            return False
+
+        if self._metrics is not None:
+            self._metrics.on_send(self, msg_id, sum(len(buffer) for buffer in frame))
+
+        if len(self._out_buffer) == 0:
+            self.update_interest()
+        self._out_buffer.extend(frame)
+
+        if not self._send_buffer_full and self.__class__.flow_control_params is not None and \
+                len(self._out_buffer) >= self.__class__.flow_control_params.high_watermark:
+            self._on_send_buffer_full()
+        return True
+
+    def _on_send_buffer_full(self):
+        params = self.__class__.flow_control_params
+        self._send_buffer_full = True
+        if params.pause_reading:
+            self.update_interest()
+        self.on_send_buffer_full()
+        if params.policy == 'disconnect':
+            self._error.set_error(Error.ERROR_SEND_BUFFER_OVERFLOW)
+
     def _unpack_and_handle_messages(self):
-        while True:
-            pair = self._unpack_message()
-            if pair in (0, -1):
-                break
+        pairs, error = self._unpack_messages()
+
+        for pair in pairs:
             if not _is_valid_message_format(pair):
                 try:
                     logger.error('%s invalid message format: %s', self.get_low_level_desc(), str(pair))
@@ -520,38 +2157,274 @@ class _Session(AsynMsgDispatcher):
                 self._error.set_error(Error.ERROR_RECV_MESSAGE_FORMAT)
                 break
 
-            code = self.handle_message(pair[0], pair[1])
-            if code is False and not self._error.has_error():
-                logger.error('%s handle message(%s) error', self.get_low_level_desc(), pair[0])
-                self._error.set_error(Error.ERROR_HANDLE_MESSAGE)
+            if self._offload_busy:  # keep order behind the offloaded handler
+                self._offload_backlog.append(pair)
+                continue
 
+            self._dispatch_message(pair[0], pair[1])
             if self._error.has_error():
                 break
 
-    # 0: retry
-    # -1: error
-    def _unpack_message(self):
-        size_length = struct.calcsize(self.__class__.message_packer.size_fmt)
-        buff_length = len(self._in_buffer)
-        if buff_length < size_length:
-            return 0
-        length = struct.unpack_from(self.__class__.message_packer.size_fmt, self._in_buffer)[0]
-        if length < size_length or length > self.__class__.max_message_size:
-            logger.error('%s invalid message size(%d), must between [%d~%d]', self.get_low_level_desc(), length, size_length, self.__class__.max_message_size)
-            self._error.set_error(Error.ERROR_UNPACK_INVALID_MESSAGE_SIZE)
-            return -1
-        if buff_length < length:
-            return 0
-        byte_msg = self._in_buffer[size_length:length]
+        if error != Error.ERROR_OK:
+            self._error.set_error(error)
 
+    def _dispatch_message(self, msg_id, msg_data):
+        if self._metrics is None and _watchdog is None and _profiler is None:
+            code = self.handle_message(msg_id, msg_data)
+        else:
+            code = self._dispatch_message_measured(msg_id, msg_data)
+        self._check_handle_result(msg_id, code)
+
+    def _dispatch_message_measured(self, msg_id, msg_data):
+        watchdog = _watchdog
+        if watchdog is not None:
+            watchdog.begin_handler(self, msg_id)
+        profiler = _profiler
+        profile_row = profiler.begin_handler(msg_id) if profiler is not None else None
+        start_time = _perf_counter()
         try:
-            pair = self.message_packer.unpack(byte_msg)
-        except:
-            self._error.set_error(Error.ERROR_UNPACK_DECODE_MESSAGE)
-            return -1
+            return self.handle_message(msg_id, msg_data)
+        finally:
+            seconds = _perf_counter() - start_time
+            if self._metrics is not None:
+                self._metrics.on_handled(msg_id, seconds)
+            if profile_row is not None:
+                profiler.end_handler(profile_row, seconds)
+            if watchdog is not None:
+                watchdog.end_handler()
+
+    def _check_handle_result(self, msg_id, code):
+        if code is False and not self._error.has_error():
+            logger.error('%s handle message(%s) error', self.get_low_level_desc(), msg_id)
+            self._error.set_error(Error.ERROR_HANDLE_MESSAGE)
+
+    def _offload_message(self, handler, msg_id, msg_data):
+        kind = handler._message_handler_executor
+        if kind == 'process':
+            future = _get_executor(kind).submit(handler, msg_id, msg_data)
+        else:
+            future = _get_executor(kind).submit(handler, self, msg_id, msg_data)
+        self._offload_busy = True
+        self.update_interest()
+        context = self._call_context
+        future.add_done_callback(lambda f: _call_soon_threadsafe(self._on_offload_done, handler, msg_id, f, context))
+        return True
 
-        self._in_buffer = self._in_buffer[length:]
-        return pair
+    def _on_offload_done(self, handler, msg_id, future, context=None):
+        self._offload_busy = False
+        if self._error.has_error() or self.socket is None:
+            return
+
+        self._call_context = context  # the callback may reply
+        try:
+            self._handle_offload_result(handler, msg_id, future)
+        finally:
+            self._call_context = None
+
+        while self._offload_backlog and not self._offload_busy and not self._error.has_error():
+            pair = self._offload_backlog.popleft()
+            self._dispatch_message(pair[0], pair[1])
+        self.update_interest()  # reading resumes once the backlog is empty
+
+    def _handle_offload_result(self, handler, msg_id, future):
+        try:
+            result = future.result()
+        except Exception:
+            logger.exception('%s offloaded handler of message(%s) error', self.get_low_level_desc(), msg_id)
+            self._error.set_error(Error.ERROR_HANDLE_MESSAGE)
+            return
+
+        callback = handler._message_handler_callback
+        if callback is None:
+            code = result
+        elif callable(callback):
+            code = callback(self, msg_id, result)
+        else:
+            code = getattr(self, callback)(msg_id, result)
+        self._check_handle_result(msg_id, code)
+
+    def _unpack_messages(self):
+        """
+        Decode all complete messages of the receive buffer in one pass
+        :return (list of (msg_id, msg_data), the error which stopped decoding or Error.ERROR_OK)
+        """
+        size_struct = self.__class__.message_packer.size_struct
+        size_length = size_struct.size
+        if len(self._in_buffer) < size_length:
+            return [], Error.ERROR_OK
+
+        max_message_size = self.__class__.max_message_size
+        unpack = self.message_packer.unpack
+        profiler = _profiler
+        compression = self.__class__.compression_params
+
+        in_view = self._in_buffer.peek()
+        buff_length = len(in_view)
+        offset = 0
+        pairs = []
+        error = Error.ERROR_OK
+
+        while buff_length - offset >= size_length:
+            length = size_struct.unpack_from(in_view, offset)[0]
+            if length < size_length or length > max_message_size:
+                logger.error('%s invalid message size(%d), must between [%d~%d]', self.get_low_level_desc(), length, size_length, max_message_size)
+                error = Error.ERROR_UNPACK_INVALID_MESSAGE_SIZE
+                break
+            if buff_length - offset < length:
+                break
+            byte_msg = in_view[offset + size_length:offset + length]
+            if PY2:
+                byte_msg = byte_msg.tobytes()
+
+            try:
+                if self._recv_compressed:
+                    byte_msg = self._decompress_frame(byte_msg)
+                if profiler is None or not profiler.sample_unpack():
+                    pair = unpack(byte_msg)
+                else:
+                    start_time = _perf_counter()
+                    pair = unpack(byte_msg)
+                    profiler.on_unpack(pair, _perf_counter() - start_time)
+            except:
+                error = Error.ERROR_UNPACK_DECODE_MESSAGE
+                break
+
+            pairs.append(pair)
+            offset += length
+
+            # frames after the ack of the peer are flagged
+            if compression is not None and not self._recv_compressed and \
+                    _is_valid_message_format(pair) and pair[0] == compression.ack_id:
+                self._recv_compressed = True
+
+            if self._metrics is not None:
+                self._metrics.on_recv(self, pair[0] if _is_valid_message_format(pair) else None, length)
+
+        self._in_buffer.consume(offset)
+        return pairs, error
+
+    def _on_rpc_request(self, msg_id, msg_data):
+        if not isinstance(msg_data, tuple) or len(msg_data) != 3 or msg_data[1] is None:
+            return self._on_invalid_system_message(msg_id, msg_data)
+        call_id, msg_id, msg_data = msg_data
+        if msg_id not in self.__class__._command_factory:
+            logger.warning('%s unhandled call(%s) of message(%s)', self.get_low_level_desc(), call_id, msg_id)
+            return self.send_reply(call_id, None, 'unhandled message(%s)' % (msg_id,))
+
+        self._call_context = call_id
+        try:
+            return self.handle_message(msg_id, msg_data)
+        finally:
+            self._call_context = None
+
+    def _on_rpc_reply(self, msg_id, msg_data):
+        if not isinstance(msg_data, tuple) or len(msg_data) != 3:
+            return self._on_invalid_system_message(msg_id, msg_data)
+        call_id, error, msg_data = msg_data
+        item = self._calls.pop(call_id, None)
+        if item is None:  # timeout or cancelled
+            return
+        item[1].cancel()
+        item[0]._complete(msg_data, RpcError(error) if error is not None else None)
+
+    def _on_call_timeout(self, call_id):
+        item = self._calls.pop(call_id, None)
+        if item is not None:
+            item[0]._complete(None, RpcTimeoutError('call(%s) of message(%s) timeout' % (call_id, item[0].msg_id)))
+
+    def _forget_call(self, call_id):
+        item = self._calls.pop(call_id, None)
+        if item is not None:
+            item[1].cancel()
+
+    def _queue_stream_fragments(self):
+        params = self.__class__.stream_params
+        max_send_size_once = self.__class__.max_send_size_once
+        while self._out_streams and len(self._out_buffer) < max_send_size_once:
+            stream = self._out_streams[0]
+            msg_id, data, offset = stream
+            end = offset + params.fragment_size
+            last = end >= len(data)
+            if not self.send_message(params.fragment_id, (msg_id, data[offset:end], last)):
+                self._out_streams.clear()
+                return
+            if last:
+                self._out_streams.popleft()
+            else:
+                stream[2] = end
+
+    def _on_stream_fragment(self, msg_id, msg_data):
+        if not isinstance(msg_data, tuple) or len(msg_data) != 3 or msg_data[0] is None or \
+                not isinstance(msg_data[1], (bytes, bytearray, memoryview)):
+            return self._on_invalid_system_message(msg_id, msg_data)
+        msg_id, fragment, last = msg_data
+        handler = self.__class__._command_factory.get(msg_id)
+        if handler is not None and getattr(handler, '_message_handler_stream', False):
+            return handler(self, msg_id, fragment, last)
+
+        stream = self._in_stream
+        if stream is None:
+            stream = self._in_stream = [msg_id, [], 0]
+        elif stream[0] != msg_id:
+            logger.error('%s stream message(%s) interleaved with message(%s)', self.get_low_level_desc(), msg_id, stream[0])
+            self._error.set_error(Error.ERROR_RECV_MESSAGE_FORMAT)
+            return False
+        stream[1].append(fragment)
+        stream[2] += len(fragment)
+        if stream[2] > self.__class__.stream_params.max_stream_size:
+            logger.error('%s stream message(%s) exceeds %d bytes', self.get_low_level_desc(), msg_id,
+                         self.__class__.stream_params.max_stream_size)
+            self._error.set_error(Error.ERROR_RECV_STREAM_OVERFLOW)
+            return False
+        if not last:
+            return True
+
+        self._in_stream = None
+        return self.handle_message(msg_id, b''.join(stream[1]))
+
+    def _decompress_frame(self, byte_msg):
+        flag = byte_msg[0]
+        if flag == _FRAME_RAW:
+            return byte_msg[1:]
+        if flag == _FRAME_COMPRESSED:
+            return self.__class__.compression_params.decompress(byte_msg[1:], self.__class__.max_message_size)
+        raise ValueError('invalid frame flag %r' % flag)
+
+    def _on_compression_hello(self, msg_id, msg_data):
+        params = self.__class__.compression_params
+        if msg_data != params.dictionary_id:
+            logger.warning('%s compression dictionary mismatch(%s != %s), not compressed',
+                           self.get_low_level_desc(), msg_data, params.dictionary_id)
+            return
+        if not self._send_compressed:
+            self.send_message(params.ack_id, params.dictionary_id)
+            self._send_compressed = True
+
+    def _on_compression_ack(self, msg_id, msg_data):
+        # receive side was switched by _unpack_messages
+        if not self._send_compressed:
+            self.send_message(self.__class__.compression_params.ack_id, msg_data)
+            self._send_compressed = True
+
+    def _schedule_keep_alive(self):
+        params = self.__class__.keep_alive_params
+        if params is None or self._keep_alive_probe_count > params.probes:
+            return
+
+        # reads only move _last_read_time, the timer reschedules itself lazily when it expires
+        check_time = self._last_read_time + params.idle_time + self._keep_alive_probe_count * params.interval
+        self._keep_alive_timer = call_at(check_time, self._on_keep_alive_timer)
+
+    def _on_keep_alive_timer(self):
+        self._keep_alive_timer = None
+        if self._error.has_error():
+            return
+        self._keep_alive_check()
+        self._schedule_keep_alive()
+
+    def _on_force_close_timer(self):
+        self._force_close_timer = None
+        self._error.set_error(Error.ERROR_FORCE_CLOSE)
 
     def _keep_alive_check(self):
         if self.__class__.keep_alive_params is None:
@@ -567,11 +2440,18 @@ class _Session(AsynMsgDispatcher):
             if self._keep_alive_probe_count > self.__class__.keep_alive_params.probes:
                 self._error.set_error(Error.ERROR_KEEP_ALIVE_TIMEOUT)
             else:
+                if self._keep_alive_ping_time is None:
+                    self._keep_alive_ping_time = time.time()
                 self.send_message(self.__class__.keep_alive_params.ping_id, None)
 
     def _on_keep_alive_ping(self, msg_id, msg_data):
         self.send_message(self.__class__.keep_alive_params.pong_id, None)
 
+    def _on_keep_alive_pong(self, msg_id, msg_data):
+        if self._keep_alive_ping_time is not None:
+            self._rtt = _smooth_rtt(self._rtt, time.time() - self._keep_alive_ping_time)
+            self._keep_alive_ping_time = None
+
 
 class SessionS(_Session):
     def __init__(self, sock, address):
@@ -587,25 +2467,43 @@ class SessionS(_Session):
 class Server(AsynMsgDispatcher):
     session_class = SessionS
     only_stop_self_when_tick_error = False
+    listen_backlog = 5
 
     def __init__(self):
         AsynMsgDispatcher.__init__(self)
         self._session_map = {}
+        self._ready_map = {}  # serial -> session whose is_ready() is True
+        self._dirty_map = {}  # serial -> session having received data or an error since it was ticked
+        self._tick_every_session = False  # session_class overrides tick or get_next_deadline
+        self._topic_map = {}  # topic -> {serial: session}
+        self._index_map = {}  # index name -> (key_func, {key: {serial: session}})
         self._next_serial = 0
         self._error = Error()
+        self._metrics = None
 
         self._listen_address = ''
+        self._reuse_port = False
 
     def set_listen_address(self, address):
         self._listen_address = address
 
+    def set_reuse_port(self, reuse_port=True):
+        """Let several processes listen on the same address(SO_REUSEPORT), the kernel balances accepts"""
+        self._reuse_port = reuse_port
+
     def start(self):
         assert not self.is_started()
 
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
         self.set_reuse_addr()
+        if self._reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.bind(self._listen_address)
-        self.listen(5)
+        self.listen(self.__class__.listen_backlog)
+
+        session_class = self.__class__.session_class
+        self._tick_every_session = _get_function(session_class, 'tick') is not _get_function(_Session, 'tick') or \
+                                   _get_function(session_class, 'get_next_deadline') is not _get_function(_Session, 'get_next_deadline')
 
         _runner_list.append(self)
 
@@ -629,15 +2527,44 @@ class Server(AsynMsgDispatcher):
         if self._error.has_error():  # by dispatcher
             return False
 
-        for session in list(self._session_map.values()):  # make a list copy in case: session remove from map by _close_session
-            if session.get_error().has_error():
-                self._close_session(session)
+        if self._tick_every_session:
+            self._dirty_map.clear()
+            for session in list(self._session_map.values()):  # make a list copy in case: session remove from map by _close_session
+                if session.get_error().has_error():
+                    self._close_session(session)
 
-        for session in self._session_map.values():
-            session.tick()
+            for session in self._session_map.values():
+                session.tick()
+            return True
+
+        # only sessions marked by handle_read or an error(including those set by timers and handle_close) have work
+        if self._dirty_map:
+            sessions = list(self._dirty_map.values())
+            self._dirty_map.clear()
+            for session in sessions:
+                if session._manage_owner is not self:
+                    continue  # closed meanwhile
+                if session.get_error().has_error():
+                    self._close_session(session)
+                else:
+                    session.tick()  # an error it sets marks it again, closed by the next tick
 
         return True
 
+    def get_next_deadline(self):
+        if self._error.has_error():
+            return 0
+
+        if not self._tick_every_session:
+            return 0 if self._dirty_map else None
+
+        deadline = None
+        for session in self._session_map.values():
+            session_deadline = session.get_next_deadline()
+            if session_deadline is not None and (deadline is None or session_deadline < deadline):
+                deadline = session_deadline
+        return deadline
+
     def is_started(self):
         return self.socket is not None
 
@@ -661,23 +2588,150 @@ class Server(AsynMsgDispatcher):
     def find_session(self, serial):
         return self._session_map.get(serial)
 
-    def get_sessions(self):
-        result = []
+    def get_session_count(self):
+        return len(self._session_map)
+
+    def enable_metrics(self, enable=True):
+        self._metrics = Metrics() if enable else None
         for session in self._session_map.values():
-            result.append(session)
-        return result
+            session._metrics = self._metrics
+
+    def get_metrics(self):
+        return self._metrics
+
+    def get_metrics_snapshot(self):
+        if self._metrics is None:
+            return None
+        return self._metrics.snapshot(self._session_map.values())
+
+    def get_sessions(self):
+        return list(self._session_map.values())
 
     def get_ready_sessions(self):
-        result = []
-        for session in self._session_map.values():
-            if session.is_ready():
-                result.append(session)
-        return result
+        return list(self._ready_map.values())
+
+    def get_ready_session_count(self):
+        return len(self._ready_map)
+
+    # iter_* do not copy: do not open, close, set_ready or re-tag sessions while iterating
+    def iter_sessions(self):
+        return iter(self._session_map.values())
+
+    def iter_ready_sessions(self):
+        return iter(self._ready_map.values())
 
     def broadcast(self, msg_id, msg_data=None):
-        for session in self._session_map.values():
-            if session.is_ready():
+        self.multicast(list(self._ready_map.values()), msg_id, msg_data)
+
+    def multicast(self, sessions, msg_id, msg_data=None):
+        """Send a message to sessions, the message is packed only once and the frame is shared"""
+        if not isinstance(sessions, list):
+            sessions = list(sessions)  # a snapshot, set_ready in send hooks(on_send_buffer_full) changes iter_* views
+        session_class = self.__class__.session_class
+        if _get_function(session_class, 'send_message') is not _get_function(_Session, 'send_message'):
+            # customized send_message(e.g. serialize msg_data first) must see every message
+            for session in sessions:
                 session.send_message(msg_id, msg_data)
+            return
+
+        frames = [None, None]  # raw and compressed frame
+        for session in sessions:
+            compressed = session._send_compressed
+            frame = frames[compressed]
+            if frame is None:
+                frame = frames[compressed] = session_class.pack_frame(msg_id, msg_data, compressed)
+            session.send_frame(frame, msg_id)
+
+    def subscribe(self, session, topic):
+        sessions = self._topic_map.get(topic)
+        if sessions is None:
+            sessions = self._topic_map[topic] = {}
+        sessions[session.get_serial()] = session
+        session._topics.add(topic)
+
+    def unsubscribe(self, session, topic):
+        sessions = self._topic_map.get(topic)
+        if sessions is None or session.get_serial() not in sessions:
+            return
+        del sessions[session.get_serial()]
+        if len(sessions) == 0:
+            del self._topic_map[topic]
+        session._topics.discard(topic)
+
+    def get_topic_sessions(self, topic):
+        return list(self._topic_map.get(topic, {}).values())
+
+    def iter_topic_sessions(self, topic):
+        return iter(self._topic_map.get(topic, {}).values())
+
+    def publish(self, topic, msg_id, msg_data=None):
+        """Send a message to the ready sessions subscribed to topic"""
+        sessions = self._topic_map.get(topic)
+        if sessions is None:
+            return
+        self.multicast([session for session in sessions.values() if session.is_ready()], msg_id, msg_data)
+
+    def add_index(self, name, key_func=None):
+        """
+        Index sessions by key(e.g. user id, room or shard key): key_func(session) when a session opens or update_index,
+        or set_index_key. A session has one key(None for not indexed) per index.
+        """
+        assert name not in self._index_map
+        self._index_map[name] = (key_func, {})
+        if key_func is not None:
+            for session in self._session_map.values():
+                self.set_index_key(session, name, key_func(session))
+
+    def remove_index(self, name):
+        key_func, key_map = self._index_map.pop(name)
+        for sessions in key_map.values():
+            for session in sessions.values():
+                del session._index_keys[name]
+
+    def set_index_key(self, session, name, key):
+        key_map = self._index_map[name][1]
+        serial = session.get_serial()
+        old_key = session._index_keys.pop(name, None)
+        if old_key is not None:
+            sessions = key_map[old_key]
+            del sessions[serial]
+            if len(sessions) == 0:
+                del key_map[old_key]
+        if key is not None:
+            sessions = key_map.get(key)
+            if sessions is None:
+                sessions = key_map[key] = {}
+            sessions[serial] = session
+            session._index_keys[name] = key
+
+    def update_index(self, session, name=None):
+        """Re-tag session by key_func of the index name, or of all indexes"""
+        for index_name in ([name] if name is not None else list(self._index_map)):
+            key_func = self._index_map[index_name][0]
+            if key_func is not None:
+                self.set_index_key(session, index_name, key_func(session))
+
+    def get_index_key(self, session, name):
+        return session._index_keys.get(name)
+
+    def get_index_keys(self, name):
+        return self._index_map[name][1].keys()
+
+    def find_index_session(self, name, key):
+        """Any one session with key, None if no such session"""
+        sessions = self._index_map[name][1].get(key)
+        if not sessions:
+            return None
+        return next(iter(sessions.values()))
+
+    def get_index_sessions(self, name, key):
+        return list(self._index_map[name][1].get(key, {}).values())
+
+    def iter_index_sessions(self, name, key):
+        return iter(self._index_map[name][1].get(key, {}).values())
+
+    def get_index_session_count(self, name, key):
+        return len(self._index_map[name][1].get(key, ()))
 
     def check_session_open(self, session):
         return session.check_open()
@@ -708,16 +2762,35 @@ class Server(AsynMsgDispatcher):
         session._serial = self._next_serial
         self._next_serial += 1
         self._session_map[session.get_serial()] = session
+        session._ready_map = self._ready_map
+        session.set_ready(session.is_ready())
+        session._dirty_map = self._dirty_map
+        if session.get_error().has_error():
+            session._mark_dirty()
+        session._metrics = self._metrics
         #}
+        for name, (key_func, key_map) in self._index_map.items():
+            if key_func is not None:
+                self.set_index_key(session, name, key_func(session))
 
         self.on_session_opened(session)
         return True
 
     def _close_session(self, session):
         self.on_session_closing(session)
+        if self._metrics is not None:
+            self._metrics.on_closed(session)
 
         #{ break link
+        for topic in list(session.get_topics()):
+            self.unsubscribe(session, topic)
+        for name in list(session._index_keys):
+            self.set_index_key(session, name, None)
         del self._session_map[session.get_serial()]
+        self._ready_map.pop(session.get_serial(), None)
+        session._ready_map = None
+        self._dirty_map.pop(session.get_serial(), None)
+        session._dirty_map = None
         session._manage_owner = None
         #}
 
@@ -725,9 +2798,171 @@ class Server(AsynMsgDispatcher):
         self.on_session_closed(session)
 
 
+class PreforkServer:
+    """
+    Fork worker processes which each run a server_class instance listening on the same address
+    with SO_REUSEPORT, so the kernel balances accepted connections among them.
+    The supervisor(the calling process) restarts crashed workers and forwards stop to all workers.
+    Must be started before any runner in the supervisor process, only available on platforms having fork.
+    """
+    server_class = Server
+    restart_delay = 1  # seconds to wait before restarting a crashed worker
+    supervise_interval = 1
+    report_interval = 1  # seconds between two session count reports of a worker
+    worker_poll_timeout = None  # timeout of run_forever in workers, None for a pure event driven loop(stop wakes the reactor)
+
+    def __init__(self, worker_count=None):
+        if worker_count is None:
+            worker_count = _cpu_count()
+        self._worker_count = worker_count
+        self._listen_address = ''
+        self._started = False
+        self._stopping = False
+        self._workers = {}  # pid -> worker index
+        self._session_counts = None  # shared memory, one unsigned int per worker
+
+        self._worker_stopping = False  # only used in worker processes
+
+    def set_listen_address(self, address):
+        self._listen_address = address
+
+    def start(self):
+        assert not self.is_started()
+        if not hasattr(os, 'fork') or not hasattr(socket, 'SO_REUSEPORT'):
+            raise RuntimeError('PreforkServer requires os.fork and SO_REUSEPORT.')
+
+        self._session_counts = mmap.mmap(-1, _SESSION_COUNT_STRUCT.size * self._worker_count)
+        self._started = True
+        self._stopping = False
+
+        self.log_info('%s(%s:%d) start %d workers...' % (self.__class__.__name__, self._listen_address[0], self._listen_address[1], self._worker_count))
+        for index in range(self._worker_count):
+            self._fork_worker(index)
+        return True
+
+    def stop(self):
+        """Stop all workers, serve_forever returns when they all exited"""
+        if not self.is_started() or self._stopping:
+            return
+        self._stopping = True
+        self.log_info('%s(%s:%d) stop workers' % (self.__class__.__name__, self._listen_address[0], self._listen_address[1]))
+        for pid in self._workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def serve_forever(self):
+        """Supervise the workers until stop is called or SIGTERM/SIGINT received"""
+        assert self.is_started()
+
+        signal.signal(signal.SIGTERM, self._on_stop_signal)
+        signal.signal(signal.SIGINT, self._on_stop_signal)
+
+        while self._workers:
+            if self._stopping:
+                pid, status = os.waitpid(-1, 0)
+            else:
+                time.sleep(self.__class__.supervise_interval)
+                pid, status = os.waitpid(-1, os.WNOHANG)
+                self.on_supervise()
+            while pid != 0:
+                self._on_worker_exited(pid, status)
+                if not self._workers:
+                    break
+                pid, status = os.waitpid(-1, os.WNOHANG)
+
+        self._session_counts.close()
+        self._session_counts = None
+        self._started = False
+
+    def is_started(self):
+        return self._started
+
+    def get_worker_count(self):
+        return self._worker_count
+
+    def get_worker_session_counts(self):
+        return [_SESSION_COUNT_STRUCT.unpack_from(self._session_counts, index * _SESSION_COUNT_STRUCT.size)[0]
+                for index in range(self._worker_count)]
+
+    def get_session_count(self):
+        return sum(self.get_worker_session_counts())
+
+    def on_supervise(self):
+        """Called in the supervisor every supervise_interval seconds"""
+        pass
+
+    def run_worker(self, index):
+        """Body of a worker process"""
+        server = self.__class__.server_class()
+        server.set_listen_address(self._listen_address)
+        server.set_reuse_port(True)
+        server.start()
+
+        self._report_session_count(server, index)
+        run_forever(extra_tick=self._check_worker_stopping, timeout=self.__class__.worker_poll_timeout)
+
+    def _fork_worker(self, index):
+        pid = os.fork()
+        if pid != 0:
+            self._workers[pid] = index
+            return
+
+        code = 0
+        try:
+            _reinit_after_fork()
+            signal.signal(signal.SIGTERM, self._on_worker_stop_signal)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)  # the supervisor forwards stop
+            self.run_worker(index)
+        except:
+            logger.exception('%s worker %d error' % (self.__class__.__name__, index))
+            code = 1
+        finally:
+            logging.shutdown()
+            os._exit(code)
+
+    def _on_worker_exited(self, pid, status):
+        index = self._workers.pop(pid, None)
+        if index is None:
+            return
+        _SESSION_COUNT_STRUCT.pack_into(self._session_counts, index * _SESSION_COUNT_STRUCT.size, 0)
+        if self._stopping:
+            return
+
+        self.log_info('%s worker %d(pid %d) exited with status %d, restart after %d seconds' % (
+            self.__class__.__name__, index, pid, status, self.__class__.restart_delay), 'error')
+        time.sleep(self.__class__.restart_delay)
+        if not self._stopping:
+            self._fork_worker(index)
+
+    def _on_stop_signal(self, signum, frame):
+        self.stop()
+
+    def _on_worker_stop_signal(self, signum, frame):
+        self._worker_stopping = True
+        if _reactor is not None:
+            _reactor.wakeup()
+
+    def _check_worker_stopping(self):
+        return not self._worker_stopping
+
+    def _report_session_count(self, server, index):
+        _SESSION_COUNT_STRUCT.pack_into(self._session_counts, index * _SESSION_COUNT_STRUCT.size, server.get_session_count())
+        call_later(self.__class__.report_interval, self._report_session_count, server, index)
+
+    def log(self, message):
+        _wrapper_asyncore_log(message, 'info')
+
+    def log_info(self, message, type='info'):
+        _wrapper_asyncore_log(message, type)
+
+
 class SessionC(_Session):
     def __init__(self, sock, address):
         _Session.__init__(self, sock, address)
+        if self.__class__.compression_params is not None:
+            self.send_message(self.__class__.compression_params.hello_id, self.__class__.compression_params.dictionary_id)
 
     def on_opened(self):
         logger.info('%s connected' % (self.get_low_level_desc()))
@@ -736,7 +2971,42 @@ class SessionC(_Session):
         logger.info('%s disconnect, error(%s)' % (self.get_low_level_desc(), self._error))
 
 
+class _Connector(AsynMsgDispatcher):
+    """Non-blocking connect of a Client or ClientInfinite, the connected socket is handed over to the client"""
+    def __init__(self, client):
+        AsynMsgDispatcher.__init__(self)
+        self._client = client
+
+    def handle_connect(self):
+        #{ detach socket and forward to client
+        self.del_channel()
+        sock = self.socket
+        self.socket = None
+        #}
+        self._client._on_connect_done(self, sock, 0)
+
+    def handle_read(self):
+        pass
+
+    def handle_write(self):
+        pass
+
+    def handle_close(self):
+        code = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        self.close()
+        self._client._on_connect_done(self, None, code)
+
+    def handle_error(self):
+        error = sys.exc_info()[1]  # raised by asyncore when connect failed
+        if not isinstance(error, socket.error) or not error.args or not isinstance(error.args[0], int):
+            AsynMsgDispatcher.handle_error(self)
+            return
+        self.close()
+        self._client._on_connect_done(self, None, error.args[0])
+
+
 class Client:
+    """Connect to one address through the loop, tick fails(so the loop stops it) when the connection fails or closes"""
     session_class = SessionC
     only_stop_self_when_tick_error = False
 
@@ -744,10 +3014,14 @@ class Client:
         self._started = False
         self._session = None
         self._next_serial = 0
+        self._metrics = None
         self._error = Error()
 
         self._connect_address = None
         self._connect_timeout = 5
+        self._connector = None
+        self._connect_timer = None
+        self._connect_callbacks = []
 
     def set_connect_address(self, address):
         self._connect_address = address
@@ -755,32 +3029,66 @@ class Client:
     def set_connect_timeout(self, timeout):
         self._connect_timeout = timeout
 
-    def _do_connect(self):
-        sock = socket.socket()
-        code, err = _connect_with_timeout(sock, self._connect_address, self._connect_timeout)
+    def add_connect_callback(self, callback):
+        """callback(client) is called once when the connecting started by start opened the session or failed"""
+        self._connect_callbacks.append(callback)
 
-        if code == -1: # error
-            self._error.set_error(Error.ERROR_CONNECT_SYSTEM, err)
-            sock.close()
-            return False
+    def _do_connect(self):
+        """Start a non-blocking connect, finished by _on_connect_done or _on_connect_timeout"""
+        self._connector = _Connector(self)
+        self._connect_timer = call_later(self._connect_timeout, self._on_connect_timeout)
+        try:
+            self._connector.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._connector.connect(self._connect_address)  # may handle_connect inside
+        except socket.error as e:
+            self._connector.close()
+            self._on_connect_done(self._connector, None, e.args[0])
+        return not self._error.has_error()
 
-        if code == 1: # timeout
-            self._error.set_error(Error.ERROR_CONNECT_TIMEOUT)
-            sock.close()
-            return False
+    def _on_connect_done(self, connector, sock, system_error):
+        self._connector = None
+        if self._connect_timer is not None:
+            self._connect_timer.cancel()
+            self._connect_timer = None
 
-        if not self._open_session(sock, self._connect_address):
+        if sock is None:
+            if system_error == errno.ECONNREFUSED:
+                self._error.set_error(Error.ERROR_CONNECT_REFUSED, system_error)
+            else:
+                self._error.set_error(Error.ERROR_CONNECT_SYSTEM, system_error)
+        elif not self._open_session(sock, self._connect_address):
             self._error.set_error(Error.ERROR_CONNECT_OPEN)
-            return False
+        self._finish_connect()
 
-        return True
+    def _on_connect_timeout(self):
+        self._connect_timer = None
+        if self._connector is not None:
+            self._connector.close()
+            self._connector = None
+        self._error.set_error(Error.ERROR_CONNECT_TIMEOUT)
+        self._finish_connect()
+
+    def _finish_connect(self):
+        if self._error.has_error():
+            self.log_info('%s(%s:%d) connect failure(%s)' % (self.__class__.__name__, self._connect_address[0], self._connect_address[1], self._error))
+            if self._started:  # failed after start returned, only this client stops, get_error tells why
+                _runner_list.remove(self)
+                self._started = False
+        callbacks, self._connect_callbacks = self._connect_callbacks, []
+        for callback in callbacks:
+            callback(self)
 
     def start(self):
+        """
+        Start connecting, return False if it failed immediately.
+        A later connect failure stops only this client(is_started() becomes False) and is kept in get_error,
+        connect callbacks are called either way.
+        """
         assert not self.is_started()
 
+        self._error.clear()
         self.log_info('%s(%s:%d) start connecting...' % (self.__class__.__name__, self._connect_address[0], self._connect_address[1]))
         if not self._do_connect():
-            self.log_info('%s(%s:%d) connect failure(%s)' % (self.__class__.__name__, self._connect_address[0], self._connect_address[1], self._error))
             return False
 
         _runner_list.append(self)
@@ -794,7 +3102,15 @@ class Client:
 
         _runner_list.remove(self)
 
-        self._close_session()
+        if self._connector is not None:
+            self._connector.close()
+            self._connector = None
+        if self._connect_timer is not None:
+            self._connect_timer.cancel()
+            self._connect_timer = None
+            self._finish_connect()
+        if self._session is not None:
+            self._close_session()
         self._error.clear()
         self._started = False
 
@@ -804,6 +3120,9 @@ class Client:
         if self._error.has_error():
             return False
 
+        if self._session is None:
+            return True  # connecting
+
         if self._session.get_error().has_error():
             self._error.copy(self._session.get_error())
             return False
@@ -811,9 +3130,19 @@ class Client:
         self._session.tick()
         return True
 
+    def get_next_deadline(self):
+        if self._error.has_error():
+            return 0
+        if self._session is None:
+            return None  # the connect timeout is a timer
+        return self._session.get_next_deadline()
+
     def is_started(self):
         return self._started
 
+    def is_connecting(self):
+        return self._connector is not None
+
     def get_error(self):
         return self._error
 
@@ -823,6 +3152,22 @@ class Client:
     def get_ready_session(self):
         return self._session if (self._session is not None and self._session.is_ready()) else None
 
+    def enable_metrics(self, enable=True):
+        self._metrics = Metrics() if enable else None
+        for session in self._sessions():
+            session._metrics = self._metrics
+
+    def get_metrics(self):
+        return self._metrics
+
+    def get_metrics_snapshot(self):
+        if self._metrics is None:
+            return None
+        return self._metrics.snapshot(self._sessions())
+
+    def _sessions(self):
+        return [] if self._session is None else [self._session]
+
     def check_session_open(self, session):
         return session.check_open()
 
@@ -847,6 +3192,7 @@ class Client:
         session._serial = self._next_serial
         self._next_serial += 1
         self._session = session
+        session._metrics = self._metrics
         #}
 
         self.on_session_opened(session)
@@ -856,6 +3202,8 @@ class Client:
         session = self._session
 
         self.on_session_closing(session)
+        if self._metrics is not None:
+            self._metrics.on_closed(session)
 
         #{ break link
         self._session = None
@@ -872,24 +3220,141 @@ class Client:
         _wrapper_asyncore_log(message, type)
 
 
+class RetryPolicy:
+    """
+    ClientInfinite.retry_policy: the n-th retry in a row waits min(maximum, initial * multiplier ** n) seconds,
+    with jitter a uniformly random time up to that(full jitter) so reconnecting clients spread out.
+    The count restarts once a session opens.
+    """
+    def __init__(self, initial=1, maximum=60, multiplier=2, jitter=True):
+        self.initial = initial
+        self.maximum = maximum
+        self.multiplier = multiplier
+        self.jitter = jitter
+
+    def get_interval(self, attempt):
+        interval = self.maximum
+        if attempt < 64:  # multiplier ** attempt can not overflow float
+            interval = min(self.maximum, self.initial * self.multiplier ** attempt)
+        if self.jitter:
+            interval = random.uniform(0, interval)
+        return interval
+
+
+class _ConnectLimiter:
+    """At most max_connecting ClientInfinite connects in flight, the others wait for a slot in order"""
+    def __init__(self):
+        self.max_connecting = None
+        self.connecting = 0
+        self._waiting = collections.deque()
+
+    def acquire(self, client):
+        if self.max_connecting is None or self.connecting < self.max_connecting:
+            self.connecting += 1
+            return True
+        self._waiting.append(client)
+        return False
+
+    def release(self):
+        self.connecting -= 1
+        self.wake()
+
+    def cancel(self, client):
+        try:
+            self._waiting.remove(client)
+        except ValueError:
+            pass
+
+    def wake(self):
+        while self._waiting and (self.max_connecting is None or self.connecting < self.max_connecting):
+            client = self._waiting.popleft()
+            self.connecting += 1
+            call_later(0, client._on_connect_slot)  # not inside the releasing client's handler
+
+
+_connect_limiter = _ConnectLimiter()
+
+
+def set_max_connecting(count):
+    """Limit the connects in flight of all ClientInfinite(and ClientPool members) of the process, None for no limit"""
+    assert count is None or count > 0
+    _connect_limiter.max_connecting = count
+    _connect_limiter.wake()
+
+
+def get_max_connecting():
+    return _connect_limiter.max_connecting
+
+
+class _Endpoint:
+    """A connect address of ClientInfinite with its smoothed rtt and consecutive failures"""
+    def __init__(self, address):
+        self.address = address
+        self.srtt = None
+        self.failures = 0
+
+    def sort_key(self):
+        # healthy first, then the fastest, unmeasured after measured
+        return (self.failures, self.srtt is None, self.srtt or 0)
+
+
 class ClientInfinite(AsynMsgDispatcher):
+    """
+    Keep one session to the connect addresses, reconnecting when it closes.
+    With several addresses(replicas) a connect tries them in the order of get_endpoints: the next one starts when the
+    previous failed or connect_attempt_delay seconds later(happy eyeballs), up to max_parallel_connects at a time,
+    the first connected wins and the others are closed.
+    """
     session_class = SessionC
     only_stop_self_when_tick_error = False
+    retry_policy = None  # RetryPolicy, None to always wait the fixed set_wait_retry_interval
+    connect_attempt_delay = 0.25
+    max_parallel_connects = 2
 
     def __init__(self):
         AsynMsgDispatcher.__init__(self)
         self._started = False
         self._session = None
         self._next_serial = 0
+        self._metrics = None
 
-        self._connect_address = None
+        self._connect_address = None  # of the session or the last connect attempt
+        self._endpoints = []
+        self._session_endpoint = None
         self._wait_retry_interval = 10
 
         self._connect_time = 0
+        self._connect_timer = None
+        self._connectors = []
+        self._pending_endpoints = []
+        self._attempt_timer = None
+        self._retry_count = 0
+        self._connect_slot = False  # holds a slot of set_max_connecting
+        self._waiting_slot = False
+
+        self._pool = None  # the ClientPool of a member
 
     def set_connect_address(self, address):
         """在start前若没有调用该方法，则在start后调用该方法时会立即发起连接"""
-        self._connect_address = address
+        self.set_connect_addresses([address])
+
+    def set_connect_addresses(self, addresses):
+        """Replicas connected to in the order of get_endpoints, the rtt and failures of kept addresses are kept"""
+        endpoints = dict((tuple(endpoint.address), endpoint) for endpoint in self._endpoints)
+        self._endpoints = [endpoints.get(tuple(address)) or _Endpoint(address) for address in addresses]
+        if self._connect_address is None or tuple(self._connect_address) not in [tuple(address) for address in addresses]:
+            self._connect_address = addresses[0] if addresses else None
+        if self.is_started() and self._connect_timer is None and self._session is None and not self._is_connecting():
+            self._connect_timer = call_at(self._connect_time, self._on_connect_timer)
+
+    def get_endpoints(self):
+        """[(address, srtt, consecutive connect failures)] in the order a connect tries them"""
+        if self._session_endpoint is not None and self._session.get_rtt() is not None:
+            self._session_endpoint.srtt = self._session.get_rtt()
+        return [(endpoint.address, endpoint.srtt, endpoint.failures) for endpoint in self._sorted_endpoints()]
+
+    def _sorted_endpoints(self):
+        return sorted(self._endpoints, key=_Endpoint.sort_key)  # stable, ties keep the given order
 
     def set_wait_retry_interval(self, interval):
         self._wait_retry_interval = interval
@@ -897,10 +3362,8 @@ class ClientInfinite(AsynMsgDispatcher):
     def start(self):
         assert not self.is_started()
 
-        self.do_wait_retry(0)
+        self._start()
         _runner_list.append(self)
-
-        self._started = True
         return True
 
     def stop(self):
@@ -908,29 +3371,31 @@ class ClientInfinite(AsynMsgDispatcher):
             return
 
         _runner_list.remove(self)
+        self._stop()
 
-        if self._session is None:
-            self.close()
-        else:
-            self._close_session()
+    def _start(self):
+        self.do_wait_retry(0)
+        self._started = True
+
+    def _stop(self):
+        self._cancel_connect_attempts()
+        if self._session is not None:
+            self._close_session()  # schedules a retry by on_session_closed
+
+        if self._connect_timer is not None:
+            self._connect_timer.cancel()
+            self._connect_timer = None
+        self._release_connect_slot()
+        if self._waiting_slot:
+            self._waiting_slot = False
+            _connect_limiter.cancel(self)
 
         self._started = False
 
     def tick(self):
         assert self.is_started()
 
-        if self._session is None:
-            if self.socket is None:
-                if self._connect_time < time.time():
-                    if self._connect_address is not None:
-                        self.log_info('%s(%s:%d) start connecting...' % (self.__class__.__name__, self._connect_address[0], self._connect_address[1]))
-                        self.do_connect()
-                else:
-                    pass # 等待发起下次连接
-            else:
-                pass # 正在连接
-        else:
-            pass # 已经连接
+        # connecting is driven by the timer scheduled in do_wait_retry
 
         if self._session is not None:
             if self._session.get_error().has_error():
@@ -941,23 +3406,132 @@ class ClientInfinite(AsynMsgDispatcher):
 
         return True
 
+    def get_next_deadline(self):
+        if self._session is not None:
+            return self._session.get_next_deadline()
+        return None  # connecting, or waiting for the connect timer or set_connect_address
+
 
     def wait_retry(self, interval=None):
         if interval is None:
-            interval = self._wait_retry_interval
+            if self.retry_policy is None:
+                interval = self._wait_retry_interval
+            else:
+                interval = self.retry_policy.get_interval(self._retry_count)
+                self._retry_count += 1
         if self._connect_address is not None:
-            self.log_info('%s(%s:%d) try reconnect after %d seconds' % (self.__class__.__name__, self._connect_address[0], self._connect_address[1], interval))
+            self.log_info('%s(%s:%d) try reconnect after %.3f seconds' % (self.__class__.__name__, self._connect_address[0], self._connect_address[1], interval))
         self.do_wait_retry(interval)
 
     def do_wait_retry(self, interval):
         """在interval秒后发起连接"""
         self._connect_time = time.time() + interval
+        if self._connect_timer is not None:
+            self._connect_timer.cancel()
+        self._connect_timer = call_at(self._connect_time, self._on_connect_timer)
+
+    def _on_connect_timer(self):
+        self._connect_timer = None
+        if self._session is not None or self._is_connecting():
+            return  # 已经连接或正在连接
+        if not self._endpoints:
+            return  # 等待set_connect_address
+        if not _connect_limiter.acquire(self):
+            self._waiting_slot = True
+            return  # _on_connect_slot when a connect in flight finishes
+        self._connect_slot = True
+        self.do_connect()
+
+    def _on_connect_slot(self):
+        self._waiting_slot = False
+        self._connect_slot = True
+        if not self.is_started() or self._session is not None or self._connectors or not self._endpoints:
+            self._release_connect_slot()
+            return
+        self.do_connect()
+
+    def _release_connect_slot(self):
+        if self._connect_slot:
+            self._connect_slot = False
+            _connect_limiter.release()
+
+    def _is_connecting(self):
+        return len(self._connectors) > 0 or self._waiting_slot
 
     def do_connect(self):
-        """发起连接"""
-        assert self.socket is None
-        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.connect(self._connect_address)  # may handle_connect inside
+        """发起连接: race the connect addresses, one connect holds one slot of set_max_connecting however many it races"""
+        self._pending_endpoints = self._sorted_endpoints()
+        self._start_next_attempt()
+
+    def _start_next_attempt(self):
+        if self._attempt_timer is not None:
+            self._attempt_timer.cancel()
+            self._attempt_timer = None
+
+        while self._pending_endpoints and len(self._connectors) < self.__class__.max_parallel_connects:
+            endpoint = self._pending_endpoints.pop(0)
+            self._connect_address = endpoint.address
+            self.log_info('%s(%s:%d) start connecting...' % (self.__class__.__name__, endpoint.address[0], endpoint.address[1]))
+            connector = _Connector(self)
+            connector.endpoint = endpoint
+            connector.start_time = time.time()
+            self._connectors.append(connector)
+            try:
+                self._connect_endpoint(connector, endpoint.address)
+            except socket.error as e:
+                connector.close()
+                self._connectors.remove(connector)
+                self._on_attempt_failure(endpoint, e.args[0])
+                continue
+
+            if connector in self._connectors and self._pending_endpoints:
+                self._attempt_timer = call_later(self.__class__.connect_attempt_delay, self._on_attempt_timer)
+            return  # in flight, or finished inside connect
+
+        if not self._connectors:
+            self._release_connect_slot()  # every endpoint failed
+            self.wait_retry()
+
+    def _on_attempt_timer(self):
+        self._attempt_timer = None
+        self._start_next_attempt()
+
+    def _on_attempt_failure(self, endpoint, code):
+        endpoint.failures += 1
+        self.log_info('%s(%s:%d) connect failure, error(%s)' % (self.__class__.__name__, endpoint.address[0], endpoint.address[1],
+                                                                _str_system_error(code)))
+
+    def _on_connect_done(self, connector, sock, system_error):
+        self._connectors.remove(connector)
+        endpoint = connector.endpoint
+        if sock is None:
+            self._on_attempt_failure(endpoint, system_error)
+            self._start_next_attempt()
+            return
+
+        endpoint.failures = 0
+        endpoint.srtt = _smooth_rtt(endpoint.srtt, time.time() - connector.start_time)  # the handshake took one round trip
+        self._cancel_connect_attempts()
+        self._release_connect_slot()
+
+        self._connect_address = endpoint.address
+        self._session_endpoint = endpoint
+        if not self._open_session(sock, endpoint.address):
+            self._session_endpoint = None
+            self.wait_retry()
+
+    def _cancel_connect_attempts(self):
+        for connector in self._connectors:
+            connector.close()
+        self._connectors = []
+        self._pending_endpoints = []
+        if self._attempt_timer is not None:
+            self._attempt_timer.cancel()
+            self._attempt_timer = None
+
+    def _connect_endpoint(self, connector, address):
+        connector.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        connector.connect(address)  # may handle_connect inside
 
     def is_started(self):
         return self._started
@@ -968,6 +3542,26 @@ class ClientInfinite(AsynMsgDispatcher):
     def get_ready_session(self):
         return self._session if (self._session is not None and self._session.is_ready()) else None
 
+    def get_pool(self):
+        """The ClientPool this client is a member of, or None"""
+        return self._pool
+
+    def enable_metrics(self, enable=True):
+        self._metrics = Metrics() if enable else None
+        for session in self._sessions():
+            session._metrics = self._metrics
+
+    def get_metrics(self):
+        return self._metrics
+
+    def get_metrics_snapshot(self):
+        if self._metrics is None:
+            return None
+        return self._metrics.snapshot(self._sessions())
+
+    def _sessions(self):
+        return [] if self._session is None else [self._session]
+
     def check_session_open(self, session):
         return session.check_open()
 
@@ -982,7 +3576,7 @@ class ClientInfinite(AsynMsgDispatcher):
         self.wait_retry()
 
     def _open_session(self, sock, address):
-        session = self.__class__.session_class(sock, address)
+        session = self.session_class(sock, address)  # a ClientPool member overrides it per instance
 
         if not self.check_session_open(session):
             session.close()
@@ -993,8 +3587,10 @@ class ClientInfinite(AsynMsgDispatcher):
         session._serial = self._next_serial
         self._next_serial += 1
         self._session = session
+        session._metrics = self._metrics
         #}
 
+        self._retry_count = 0
         self.on_session_opened(session)
         return True
 
@@ -1002,6 +3598,15 @@ class ClientInfinite(AsynMsgDispatcher):
         session = self._session
 
         self.on_session_closing(session)
+        if self._metrics is not None:
+            self._metrics.on_closed(session)
+        endpoint = self._session_endpoint
+        if endpoint is not None:
+            if session.get_rtt() is not None:
+                endpoint.srtt = session.get_rtt()
+            if session.get_error().get_error() == Error.ERROR_KEEP_ALIVE_TIMEOUT:
+                endpoint.failures += 1  # prefer the other replicas
+        self._session_endpoint = None
         self._session = None
         session._manage_owner = None
         session.close()
@@ -1013,27 +3618,204 @@ class ClientInfinite(AsynMsgDispatcher):
 
     def log_info(self, message, type='info'):
         _wrapper_asyncore_log(message, type)
+    """ asyncore.dispatcher interfaces >>> """
 
-    def handle_connect(self):
-        #{ detach socket and forward to session
-        self.del_channel()
-        sock = self.socket
-        self.socket = None
-        #}
 
-        if not self._open_session(sock, self.addr):
-            self.wait_retry()
-            return
+def start_clients(clients, callback=None):
+    """
+    Start Clients connecting concurrently through the loop
+    :param callback called as callback(opened, failed) once every client opened its session or failed
+    """
+    clients = list(clients)
+    opened = []
+    failed = []
 
-    def handle_read(self):
-        return  # the concrete session will handle_read
+    def on_connect_done(client):
+        if client.get_session() is not None:
+            opened.append(client)
+        else:
+            failed.append(client)
+        if len(opened) + len(failed) == len(clients) and callback is not None:
+            callback(opened, failed)
 
-    def handle_write(self):
-        return  # the concrete session will handle_write
+    if not clients and callback is not None:
+        callback(opened, failed)
+    for client in clients:
+        client.add_connect_callback(on_connect_done)
+        client.start()
 
-    def handle_close(self):
-        self.log_info('%s(%s:%d) connect failure, error(%s)' % (self.__class__.__name__, self._connect_address[0], self._connect_address[1],
-                                                                _str_system_error(self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR))))
-        self.close()
+
+class _PoolClient(ClientInfinite):
+    """Member of a ClientPool, ticked by the pool and reporting its session events to the pool"""
+    def __init__(self, pool, session_class):
+        ClientInfinite.__init__(self)
+        self.session_class = session_class
+        self.retry_policy = pool.__class__.retry_policy
+        self._pool = pool
+
+    def start(self):
+        assert not self.is_started()
+        self._start()
+        return True
+
+    def stop(self):
+        if self.is_started():
+            self._stop()
+
+    def check_session_open(self, session):
+        return self._pool.check_session_open(session)
+
+    def on_session_opened(self, session):
+        self._pool.on_session_opened(session)
+
+    def on_session_closing(self, session):
+        self._pool.on_session_closing(session)
+
+    def on_session_closed(self, session):
+        self._pool.on_session_closed(session)
         self.wait_retry()
-    """ asyncore.dispatcher interfaces >>> """
+
+
+class ClientPool:
+    """
+    Keep pool_size sessions to the connect addresses(spread round robin), each reconnected like ClientInfinite.
+    send_message and call go to the ready session with the fewest outstanding calls, then the least pending output.
+    Sessions' get_manage_owner() is their ClientInfinite member, whose get_pool() is this pool.
+    """
+    session_class = SessionC
+    pool_size = 4
+    retry_policy = None  # RetryPolicy of every member
+
+    def __init__(self):
+        self._started = False
+        self._connect_addresses = []
+        self._wait_retry_interval = 10
+        self._clients = []
+        self._metrics = None
+
+    def set_connect_address(self, address):
+        self.set_connect_addresses([address])
+
+    def set_connect_addresses(self, addresses):
+        self._connect_addresses = list(addresses)
+        for index, client in enumerate(self._clients):
+            client.set_connect_address(self._connect_addresses[index % len(self._connect_addresses)])
+
+    def set_wait_retry_interval(self, interval):
+        self._wait_retry_interval = interval
+        for client in self._clients:
+            client.set_wait_retry_interval(interval)
+
+    def start(self):
+        assert not self.is_started()
+
+        for index in range(self.__class__.pool_size):
+            client = _PoolClient(self, self.__class__.session_class)
+            client.set_wait_retry_interval(self._wait_retry_interval)
+            if self._connect_addresses:
+                client.set_connect_address(self._connect_addresses[index % len(self._connect_addresses)])
+            client._metrics = self._metrics
+            self._clients.append(client)
+            client.start()
+        _runner_list.append(self)
+
+        self._started = True
+        return True
+
+    def stop(self):
+        if not self.is_started():
+            return
+
+        _runner_list.remove(self)
+        for client in self._clients:
+            client.stop()
+        self._clients = []
+
+        self._started = False
+
+    def tick(self):
+        assert self.is_started()
+
+        for client in self._clients:
+            client.tick()
+        return True
+
+    def get_next_deadline(self):
+        deadline = None
+        for client in self._clients:
+            client_deadline = client.get_next_deadline()
+            if client_deadline is not None and (deadline is None or client_deadline < deadline):
+                deadline = client_deadline
+        return deadline
+
+    def is_started(self):
+        return self._started
+
+    def is_ready(self):
+        """True if any session is ready"""
+        return self.get_ready_session() is not None
+
+    def get_sessions(self):
+        return [client._session for client in self._clients if client._session is not None]
+
+    def get_ready_sessions(self):
+        return [client._session for client in self._clients
+                if client._session is not None and client._session.is_ready()]
+
+    def get_ready_session(self):
+        """The ready session with the fewest outstanding calls, then the least pending output, or None"""
+        best = None
+        best_load = None
+        for client in self._clients:
+            session = client._session
+            if session is None or not session.is_ready() or session.get_error().has_error():
+                continue
+            load = (len(session._calls), len(session._out_buffer))
+            if best is None or load < best_load:
+                best = session
+                best_load = load
+        return best
+
+    def send_message(self, msg_id, msg_data=None):
+        session = self.get_ready_session()
+        if session is None:
+            return False
+        return session.send_message(msg_id, msg_data)
+
+    def call(self, msg_id, msg_data=None, timeout=None, callback=None):
+        session = self.get_ready_session()
+        if session is not None:
+            return session.call(msg_id, msg_data, timeout, callback)
+
+        call = RpcCall(None, msg_id)
+        if callback is not None:
+            call.add_done_callback(callback)
+        call._complete(None, RpcError('no ready session in %s' % self.__class__.__name__))
+        return call
+
+    def enable_metrics(self, enable=True):
+        self._metrics = Metrics() if enable else None
+        for client in self._clients:
+            client._metrics = self._metrics
+            for session in client._sessions():
+                session._metrics = self._metrics
+
+    def get_metrics(self):
+        return self._metrics
+
+    def get_metrics_snapshot(self):
+        if self._metrics is None:
+            return None
+        return self._metrics.snapshot(self.get_sessions())
+
+    def check_session_open(self, session):
+        return session.check_open()
+
+    def on_session_opened(self, session):
+        session.on_opened()
+
+    def on_session_closing(self, session):
+        session.on_closing()
+
+    def on_session_closed(self, session):
+        session.on_closed()
@@ -0,0 +1,285 @@
+# -*- coding: utf8 -*-
+"""
+Throughput/latency benchmark of asynmsg over loopback, results are printed as JSON.
+
+    python -m asynmsg_bench
+    python -m asynmsg_bench --duration 5 --sizes 16,1024 --sessions 1,100 --output result.json
+"""
+import sys
+import time
+import json
+import pickle
+import logging
+import platform
+import argparse
+import asynmsg
+
+ID_PING = 1
+ID_PONG = 2
+ID_BROADCAST = 3
+ID_BROADCAST_ACK = 4
+
+BENCH_SCHEMA = {ID_PING: 'bytes', ID_PONG: 'bytes', ID_BROADCAST: 'bytes', ID_BROADCAST_ACK: None}
+
+PACKERS = {
+    'pickle': asynmsg.MessagePacker_Pickle,
+    'struct': asynmsg.MessagePacker_Struct,
+    'schema': lambda size_fmt: asynmsg.MessagePacker_Schema(BENCH_SCHEMA, size_fmt),
+}
+if pickle.HIGHEST_PROTOCOL >= 5:
+    PACKERS['pickle5'] = asynmsg.MessagePacker_Pickle5
+
+
+def _percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100.0))
+    return sorted_values[index]
+
+
+class _Stats:
+    def __init__(self):
+        self.messages = 0
+        self.latencies = []
+
+    def clear(self):
+        self.messages = 0
+        self.latencies = []
+
+
+def _make_classes(packer_name, stats):
+    packer = PACKERS[packer_name]('I')
+
+    @asynmsg.with_message_handler_config
+    class BenchSessionS(asynmsg.SessionS):
+        message_packer = packer
+        keep_alive_params = None
+        max_message_size = 1024 * 1024
+
+        def on_opened(self):
+            pass
+
+        def on_closing(self):
+            pass
+
+        @asynmsg.message_handler_config(ID_PING)
+        def on_ping(self, msg_id, msg_data):
+            self.send_message(ID_PONG, msg_data)
+
+        @asynmsg.message_handler_config(ID_BROADCAST_ACK)
+        def on_broadcast_ack(self, msg_id, msg_data):
+            self.get_manage_owner().on_broadcast_ack()
+
+    @asynmsg.with_message_handler_config
+    class BenchSessionC(asynmsg.SessionC):
+        message_packer = packer
+        keep_alive_params = None
+        max_message_size = 1024 * 1024
+        payload = b''
+        pinging = False
+
+        def on_opened(self):
+            pass
+
+        def on_closing(self):
+            pass
+
+        def ping(self):
+            self.ping_time = time.time()
+            self.send_message(ID_PING, self.__class__.payload)
+
+        @asynmsg.message_handler_config(ID_PONG)
+        def on_pong(self, msg_id, msg_data):
+            stats.messages += 1
+            stats.latencies.append(time.time() - self.ping_time)
+            if self.__class__.pinging:
+                self.ping()
+
+        @asynmsg.message_handler_config(ID_BROADCAST)
+        def on_broadcast(self, msg_id, msg_data):
+            stats.messages += 1
+            self.send_message(ID_BROADCAST_ACK, None)
+
+    class BenchServer(asynmsg.Server):
+        session_class = BenchSessionS
+        listen_backlog = 1024
+
+        def __init__(self):
+            asynmsg.Server.__init__(self)
+            self.pending_acks = 0
+            self.broadcast_time = 0
+            self.payload = b''
+            self.broadcasting = False
+
+        def broadcast_once(self):
+            self.pending_acks = len(self._session_map)
+            self.broadcast_time = time.time()
+            self.broadcast(ID_BROADCAST, self.payload)
+
+        def on_broadcast_ack(self):
+            self.pending_acks -= 1
+            if self.pending_acks == 0:
+                stats.latencies.append(time.time() - self.broadcast_time)
+                if self.broadcasting:
+                    self.broadcast_once()
+
+    class BenchClient(asynmsg.ClientInfinite):
+        session_class = BenchSessionC
+
+    return BenchServer, BenchClient
+
+
+def _run_for(seconds, until=None):
+    end_time = time.time() + seconds
+    while time.time() < end_time:
+        asynmsg.run_once(extra_tick=None, timeout=0.01)
+        if until is not None and until():
+            return True
+    return until is None
+
+
+def _setup(packer_name, session_count, stats):
+    server_class, client_class = _make_classes(packer_name, stats)
+    server = server_class()
+    server.set_listen_address(('127.0.0.1', 0))
+    server.start()
+    address = server.socket.getsockname()
+
+    clients = []
+    for _ in range(session_count):
+        client = client_class()
+        client.set_connect_address(address)
+        client.start()
+        clients.append(client)
+
+    if not _run_for(30, lambda: len(server.get_ready_sessions()) == session_count and
+                                all(client.get_ready_session() is not None for client in clients)):
+        raise RuntimeError('only %d of %d sessions connected' % (len(server.get_sessions()), session_count))
+    return server, clients
+
+
+def _teardown(server, clients):
+    for client in clients:
+        client.stop()
+    server.stop()
+
+
+def _result(scenario, packer_name, size, session_count, stats, duration, cpu):
+    latencies = sorted(stats.latencies)
+    return {
+        'scenario': scenario,
+        'packer': packer_name,
+        'size': size,
+        'sessions': session_count,
+        'messages': stats.messages,
+        'duration': duration,
+        'msgs_per_sec': stats.messages / duration if duration > 0 else 0,
+        'latency_p50_us': _percentile(latencies, 50) * 1e6,
+        'latency_p99_us': _percentile(latencies, 99) * 1e6,
+        'cpu_us_per_msg': cpu / stats.messages * 1e6 if stats.messages > 0 else 0,
+    }
+
+
+def bench_pingpong(packer_name, size, session_count, duration):
+    """Every client session keeps one ping in flight, latency is the round trip time"""
+    stats = _Stats()
+    server, clients = _setup(packer_name, session_count, stats)
+    client_session_class = clients[0].__class__.session_class
+    client_session_class.payload = b'x' * size
+    client_session_class.pinging = True
+    try:
+        for client in clients:
+            client.get_session().ping()
+        _run_for(min(1.0, duration / 5.0))  # warm up
+        stats.clear()
+
+        start_time, start_cpu = time.time(), time.process_time()
+        _run_for(duration)
+        elapsed, cpu = time.time() - start_time, time.process_time() - start_cpu
+
+        client_session_class.pinging = False
+        _run_for(1.0)
+    finally:
+        _teardown(server, clients)
+    return _result('pingpong', packer_name, size, session_count, stats, elapsed, cpu)
+
+
+def bench_broadcast(packer_name, size, session_count, duration):
+    """The server broadcasts once all sessions acked the previous one, latency is the full fan-out time"""
+    stats = _Stats()
+    server, clients = _setup(packer_name, session_count, stats)
+    server.payload = b'x' * size
+    server.broadcasting = True
+    try:
+        server.broadcast_once()
+        _run_for(min(1.0, duration / 5.0))  # warm up
+        stats.clear()
+
+        start_time, start_cpu = time.time(), time.process_time()
+        _run_for(duration)
+        elapsed, cpu = time.time() - start_time, time.process_time() - start_cpu
+
+        server.broadcasting = False
+        _run_for(1.0, lambda: server.pending_acks == 0)
+    finally:
+        _teardown(server, clients)
+    return _result('broadcast', packer_name, size, session_count, stats, elapsed, cpu)
+
+
+def run(packers, sizes, session_counts, fanouts, duration):
+    results = []
+    for packer_name in packers:
+        for size in sizes:
+            for session_count in session_counts:
+                results.append(bench_pingpong(packer_name, size, session_count, duration))
+                logging.info('%s', json.dumps(results[-1]))
+            for session_count in fanouts:
+                results.append(bench_broadcast(packer_name, size, session_count, duration))
+                logging.info('%s', json.dumps(results[-1]))
+
+    return {
+        'asynmsg_version': asynmsg.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'duration': duration,
+        'results': results,
+    }
+
+
+def _int_list(text):
+    return [int(x) for x in text.split(',') if x]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m asynmsg_bench', description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--duration', type=float, default=2.0, help='seconds measured per case')
+    parser.add_argument('--packers', default='pickle,struct,schema', help='comma separated of: %s' % ','.join(sorted(PACKERS)))
+    parser.add_argument('--sizes', type=_int_list, default=[16, 1024, 16 * 1024], help='payload bytes')
+    parser.add_argument('--sessions', type=_int_list, default=[1, 10, 100], help='ping-pong session counts')
+    parser.add_argument('--fanout', type=_int_list, default=[10, 100, 1000], help='broadcast session counts')
+    parser.add_argument('--output', help='write JSON to this file instead of stdout')
+    parser.add_argument('--verbose', action='store_true', help='log every result as soon as its case finished')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='[%(asctime)s][%(levelname)-4.4s] %(message)s', datefmt='%H:%M:%S')
+    asynmsg.logger.setLevel(logging.WARNING)
+
+    packers = [x for x in args.packers.split(',') if x]
+    for packer_name in packers:
+        if packer_name not in PACKERS:
+            parser.error('unknown packer %s' % packer_name)
+
+    report = run(packers, args.sizes, args.sessions, args.fanout, args.duration)
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        sys.stdout.write(text + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -16,7 +16,7 @@ setup(
     author='Sun Jin',
     author_email='412640665@qq.com',
     url='https://github.com/sunjinopensource/asynmsg/',
-	py_modules=['asynmsg'],
+	py_modules=['asynmsg', 'asynmsg_bench'],
     classifiers=[
         'Development Status :: 3 - Alpha',
         'Intended Audience :: Developers',